@@ -19,16 +19,29 @@ along with beetFs.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+import bisect
 import calendar
+import cProfile
 import datetime
 import errno
 import fuse
+import json
 import logging
+import multiprocessing
 import operator
 import os
+import queue
 import re
+import shutil
+import sqlite3
 import stat
 import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import ChainMap, OrderedDict
+from contextlib import contextmanager
 from errno import EINVAL
 from io import BytesIO
 from string import Template
@@ -36,17 +49,51 @@ from string import Template
 import beets
 from beets.plugins import BeetsPlugin
 from beets.ui import Subcommand
+from mutagen import MutagenError
 from mutagen.flac import (FLAC, Padding, MetadataBlock, VCFLACDict, CueSheet,
-                          SeekTable, FLACNoHeaderError, FLACVorbisError)
+                          SeekTable, StreamInfo, Picture, FLACNoHeaderError,
+                          FLACVorbisError)
 from mutagen.id3 import ID3, BitPaddedInt, MakeID3v1
 from mutagen._util import insert_bytes
-from functools import reduce
 
 PATH_FORMAT = ("$artist/$album ($year) [$format_upper]/"
                "$track - $artist - $title.$format")
 
+# queries are browsed as flat directories under /.query/<query>/
+QUERY_DIR = '.query'
+QUERY_FORMAT = "$artist - $album - $track - $title.$format"
+
+# /.raw/ mirrors the tree, serving the files exactly as they are on disk
+RAW_DIR = '.raw'
+
+# a running mount is inspected and controlled through files in /.beetfs/
+CONTROL_DIR = '.beetfs'
+CONTROL_FILES = ('control', 'stats')
+
+# the title given to each track of a CUE image
+CUE_TITLE = "Track %02i"
+
+# album directories with art get a cover file; %s is the image's format
+COVER_NAME = "cover.%s"
+
+# I/O priority classes, most urgent first: reads past the header of open
+# tracks, header reads and lookups, then prefetching
+IO_CLASSES = ('audio', 'interactive', 'background')
+AUDIO, INTERACTIVE, BACKGROUND = range(len(IO_CLASSES))
+
 beetFs_command = Subcommand('mount', help='Mount a beets filesystem')
+beetFs_command.parser.add_option('--warm', action='store_true',
+                                 help='fill the header index before mounting')
+index_command = Subcommand('beetfs-index',
+                           help='Fill the beetFs header index')
+index_command.parser.add_option('-j', '--jobs', type='int',
+                                help='number of files to scan in parallel')
+write_command = Subcommand('beetfs-write',
+                           help='Write tags from the database into files')
+write_command.parser.add_option('-j', '--jobs', type='int',
+                                help='number of files to write in parallel')
 log = logging.getLogger('beets')
+config = beets.config['beetFs']
 
 
 # FUSE version at the time of writing. Be compatible with this version.
@@ -78,43 +125,498 @@ METADATA_FIELDS = [
 ] + METADATA_RW_FIELDS
 
 METADATA_KEYS = list(map(operator.itemgetter(0), METADATA_FIELDS))
+METADATA_TYPES = dict(METADATA_FIELDS)
+METADATA_RW_KEYS = list(map(operator.itemgetter(0), METADATA_RW_FIELDS))
 
+# fields are exposed as extended attributes named user.beets.<field>
+XATTR_PREFIX = 'user.beets.'
 
-def template_mapping(lib, item):
-    """ Builds a template substitution map. Taken from library.py."""
-    mapping = {}
-    for key in METADATA_KEYS:
-        value = getattr(item, key)
-        # sanitize the value for inclusion in a path:
-        # replace / and leading . with _
-        if isinstance(value, str):
-            value.replace(os.sep, '_')
-            value = re.sub(r'[\\/:]|^\.', '_', value)
-        elif key in ('track', 'tracktotal', 'disc', 'disctotal'):
-            # pad with zeros
-            value = '%02i' % value
-        else:
-            value = str(value)
-        mapping[key] = value
 
-    format_ = os.path.splitext(item.path)[1][1:].decode()
-    mapping['format'] = re.sub(r'[\\/:]|^\.', '_', format_)
-    mapping['format_upper'] = re.sub(r'[\\/:]|^\.', '_', format_).upper()
+# fields that are zero-padded when they appear in a path
+PADDED_FIELDS = ('track', 'tracktotal', 'disc', 'disctotal')
+
+# stand-ins for empty values that would make for poor path components
+DUD_VALUES = {
+    ('artist', ''): 'Unknown Artist',
+    ('album', ''): 'Unknown Album',
+    ('year', '0'): 'Unknown Year',
+    ('title', ''): 'Unknown Track',
+}
+
+# fields that are worked out from the item's path rather than stored
+DERIVED_FIELDS = ('format', 'format_upper')
+
+UNSAFE_PATH_CHARS = re.compile(r'[\\/:]|^\.')
+
+
+def path_value(key, value):
+    """ Formats a field value for inclusion in a path: strings have
+        / \\ : and a leading . replaced with _, numbering is zero-padded.
+    """
+    if isinstance(value, str):
+        value = UNSAFE_PATH_CHARS.sub('_', value)
+    elif key in PADDED_FIELDS:
+        # pad with zeros
+        value = '%02i' % (value or 0)
+    else:
+        value = str(value)
+    return DUD_VALUES.get((key, value), value)
+
+
+def path_format(path):
+    """ The file extension used as $format in paths."""
+    if isinstance(path, bytes):
+        path = path.decode('utf-8', 'replace')
+    return UNSAFE_PATH_CHARS.sub('_', os.path.splitext(path)[1][1:])
+
+
+class PathRenderer(object):
+    """ A path format compiled once into a format string per directory
+        level. Only the fields the format refers to are fetched and
+        sanitized for each item.
+    """
+    def __init__(self, format_):
+        self.levels = []
+        self.fields = []
+        for level in format_.split('/'):
+            compiled = []
+            last = 0
+            for match in Template.pattern.finditer(level):
+                compiled.append(level[last:match.start()]
+                                .replace('{', '{{').replace('}', '}}'))
+                last = match.end()
+                if match.group('escaped') is not None:
+                    compiled.append('$')
+                    continue
+                field = match.group('named') or match.group('braced')
+                if field is None:
+                    raise ValueError("invalid placeholder in path format: %s"
+                                     % level)
+                if field not in self.fields:
+                    self.fields.append(field)
+                compiled.append('{%s}' % field)
+            compiled.append(level[last:].replace('{', '{{').replace('}', '}}'))
+            self.levels.append(''.join(compiled))
+        self.depth = len(self.levels)
+
+    def columns(self):
+        """ The item table columns needed to render a path, or None if the
+            format refers to something that isn't a column (a flexible
+            attribute, say).
+        """
+        columns = []
+        for field in self.fields:
+            if field in DERIVED_FIELDS:
+                continue
+            if field not in beets.library.Item._fields:
+                return None
+            columns.append(field)
+        return columns
+
+    def mapping(self, values, path):
+        mapping = {}
+        for field in self.fields:
+            if field == 'format':
+                mapping[field] = path_format(path)
+            elif field == 'format_upper':
+                mapping[field] = path_format(path).upper()
+            else:
+                mapping[field] = path_value(field, values[field])
+        return mapping
+
+    def render(self, item, values=None):
+        """ Returns the path of item as a list of components. values
+            overrides some of the item's fields.
+        """
+        if values:
+            item_values = ChainMap(values, item)
+        else:
+            item_values = item
+        mapping = self.mapping(item_values, item.path)
+        return [level.format_map(mapping) for level in self.levels]
+
+    def render_rows(self, lib, batch=1000):
+        """ Generates (id, components) for every item in the library, in
+            id order. Rows are read straight from the items table a batch
+            at a time instead of building an Item for each.
+        """
+        columns = self.columns()
+        if columns is None:
+            for item in sorted(lib.items(), key=operator.attrgetter('id')):
+                yield item.id, self.render(item)
+            return
+
+        types = [beets.library.Item._fields[column] for column in columns]
+        sql = ("SELECT id, path%s FROM items WHERE id > ? ORDER BY id LIMIT ?"
+               % ''.join(', %s' % column for column in columns))
+        last = 0
+        while True:
+            with lib.transaction() as tx:
+                rows = tx.query(sql, (last, batch))
+            if not rows:
+                break
+            for row in rows:
+                values = {}
+                for column, type_, value in zip(columns, types, row[2:]):
+                    values[column] = type_.from_sql(value)
+                mapping = self.mapping(values, row[1])
+                yield row[0], [level.format_map(mapping)
+                               for level in self.levels]
+            last = rows[-1][0]
+
+
+def build_structure(lib, renderer):
+    """ Builds the in-memory folder structure for every item in lib."""
+    root = FSNode({}, {})
+    for id, components in renderer.render_rows(lib):
+        node = root.makedirs(components[:-1])
+        node.addfile([], components[-1], id)
+    return root
+
+
+def add_cue_tracks(lib, renderer, index, root):
+    """ Adds the tracks of every FLAC image with an embedded cue sheet
+        to root, next to the image itself, and returns {id: CueImage} for
+        those images. Only images already in the header index are found.
+    """
+    images = {}
+    for id in index.with_block(CueSheet.code):
+        item = lib.get_item(id)
+        if item is None:
+            continue
+        try:
+            image = CueImage.read(item.path, index.lookup(item))
+        except Exception as e:
+            logging.info("Couldn't read cue sheet of %s: %s" % (item.path, e))
+            continue
+        if image is None:
+            continue
+        images[id] = image
+        node = root.makedirs(renderer.render(item)[:-1])
+        for number in image.tracks:
+            name = renderer.render(item, {'track': number,
+                                          'title': CUE_TITLE % number})[-1]
+            node.addfile([], name, (id, number))
+    return images
+
+
+# bumped whenever this process stores something in the library
+library_changes = 0
+
+# item id: (time in ns, tags) of changes not yet recorded in the header
+# index
+pending_changes = {}
+
+
+def library_changed(lib=None, model=None, **kwargs):
+    """ Listener for beets' database_change event."""
+    global library_changes
+    library_changes = library_changes + 1
+    if isinstance(model, beets.library.Item) and model.id is not None:
+        # get(), so that an item without one of the fields can't make
+        # the command storing it fail
+        pending_changes[model.id] = (time.time_ns(), dict(
+            (tag, model.get(tag)) for tag in INTERPOLATED_TAGS))
+
+
+def record_changes(lib=None, index=None, **kwargs):
+    """ Listener for beets' cli_exit event. Writes the item changes seen
+        by library_changed() to the header index, in one go, so that a
+        mount can report them as mtimes. Only changes to the served tags
+        are kept (see HeaderIndex.touch_many()).
+    """
+    if not pending_changes:
+        return
+    if index is None:
+        if lib is None:
+            return
+        index = open_header_index(lib)
+    index.touch_many([(id, changed, tags) for id, (changed, tags)
+                      in pending_changes.items()])
+    pending_changes.clear()
+
+
+# how often (in seconds) the database files are checked for writes by
+# other processes
+GENERATION_INTERVAL = 1.0
+
+# (when, mtimes) of the last check, shared by all the caches
+checked_mtimes = (None, None)
+
+
+def library_generation(lib):
+    """ Returns a token that changes whenever the library does, either
+        through this process or through another beets process writing to
+        the database file. The files are looked at no more than once per
+        GENERATION_INTERVAL, however many caches ask, so writes by other
+        processes can take that long to show.
+    """
+    global checked_mtimes
+    now = time.monotonic()
+    checked, mtimes = checked_mtimes
+    if checked is None or now - checked >= GENERATION_INTERVAL:
+        mtimes = []
+        for suffix in (b'', b'-wal'):
+            try:
+                mtimes.append(os.stat(os.fsencode(lib.path) + suffix)
+                              .st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        mtimes = tuple(mtimes)
+        checked_mtimes = (now, mtimes)
+    return (library_changes, mtimes)
+
+
+class QueryCache(object):
+    """ The flat listings behind /.query/<query>/. A query is only run
+        the first time one of its entries is looked up; the result is kept
+        for ttl seconds, at most size results are kept (least recently used
+        go first) and everything is dropped when the library changes.
+    """
+    def __init__(self, lib, ttl, size):
+        self.lib = lib
+        self.ttl = ttl
+        self.size = size
+        self.renderer = PathRenderer(QUERY_FORMAT)
+        self.entries = OrderedDict()
+        self.generation = None
+
+    def queries(self):
+        self.validate()
+        return list(self.entries.keys())
+
+    def validate(self):
+        generation = library_generation(self.lib)
+        if generation != self.generation:
+            if self.entries:
+                logging.info("Library changed, dropping cached queries")
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, query):
+        self.validate()
+        now = time.time()
+        if query in self.entries:
+            expires, node = self.entries[query]
+            if expires > now:
+                self.entries.move_to_end(query)
+                return node
+
+        logging.info("Running query: %s" % query)
+        node = FSNode({}, {})
+        for item in sorted(self.lib.items(query),
+                           key=operator.attrgetter('id')):
+            node.addfile([], self.renderer.render(item)[0], item.id)
+
+        self.entries[query] = (now + self.ttl, node)
+        self.entries.move_to_end(query)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return node
+
+
+class ItemCache(object):
+    """ Recently looked-up items, so that getattr and the tag attributes
+        don't have to go to the database each time. The items are shared,
+        so callers must not change them. Everything is dropped when the
+        library changes.
+    """
+    def __init__(self, lib, size):
+        self.lib = lib
+        self.size = size
+        self.items = OrderedDict()
+        self.generation = None
+
+    def get(self, id):
+        generation = library_generation(self.lib)
+        if generation != self.generation:
+            self.items.clear()
+            self.generation = generation
+
+        item = self.items.get(id)
+        if item is not None:
+            self.items.move_to_end(id)
+            return item
+
+        item = self.lib.get_item(id)
+        if item is not None:
+            self.items[id] = item
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return item
+
+
+class NegativeCache(object):
+    """ Paths recently found not to exist, so that clients probing for
+        names like folder.jpg or .DS_Store get ENOENT without a walk of
+        the tree. Entries expire after ttl seconds, at most size are kept
+        (oldest go first) and everything is dropped when the library
+        changes.
+    """
+    def __init__(self, lib, ttl, size):
+        self.lib = lib
+        self.ttl = ttl
+        self.size = size
+        self.paths = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """ Whether path is known not to exist."""
+        generation = library_generation(self.lib)
+        if generation != self.generation:
+            self.paths.clear()
+            self.generation = generation
+
+        expires = self.paths.get(path)
+        if expires is None:
+            return False
+        if expires <= time.time():
+            del self.paths[path]
+            return False
+        self.hits = self.hits + 1
+        return True
+
+    def add(self, path):
+        """ Records that path was looked up and doesn't exist."""
+        self.misses = self.misses + 1
+        self.paths[path] = time.time() + self.ttl
+        self.paths.move_to_end(path)
+        while len(self.paths) > self.size:
+            self.paths.popitem(last=False)
+
+    def usage(self):
+        return {
+            'negative_entries': len(self.paths),
+            'negative_hits': self.hits,
+            'negative_misses': self.misses,
+        }
+
+
+class ChangeTimes(object):
+    """ When each item was last changed in the database, as recorded in
+        the header index by record_changes(). Reread whenever the library
+        changes or changes are recorded, but not when the index only gains
+        header layouts.
+    """
+    def __init__(self, lib, index):
+        self.lib = lib
+        self.index = index
+        self.times = {}
+        self.generation = None
 
-    # fix dud entries
-    if mapping['artist'] == '':
-        mapping['artist'] = 'Unknown Artist'
+    def get(self, id):
+        """ Returns the time of the last change to id in seconds, or None
+            if no change was recorded.
+        """
+        generation = (library_generation(self.lib), self.index.version())
+        if generation != self.generation:
+            self.times = self.index.modified()
+            self.generation = generation
+
+        changed = self.times.get(id)
+        if changed is None:
+            return None
+        return changed / 1e9
+
+
+def is_file(pathsplit):
+    """ Whether a split path names a file rather than a directory."""
+    if pathsplit[0] == QUERY_DIR:
+        return len(pathsplit) == 3
+    if pathsplit[0] == CONTROL_DIR:
+        return len(pathsplit) == 2
+    if pathsplit[0] == RAW_DIR:
+        return len(pathsplit) == structure_depth + 1
+    return len(pathsplit) == structure_depth
+
+
+def add_covers(lib, index, root, depth):
+    """ Gives each album directory, depth levels below root, a cover
+        file if any of its tracks has art: the art file of the track's
+        album, or failing that a picture embedded in the track.
+    """
+    with lib.transaction() as tx:
+        albums = dict(tx.query("SELECT id, album_id FROM items"))
+    artpaths = dict((album.id, album.artpath) for album in lib.albums()
+                    if album.artpath)
+    pictures = set(index.with_block(Picture.code))
+
+    nodes = [root]
+    for level in range(depth):
+        nodes = [child for node in nodes for child in node.dirs.values()]
+    for node in nodes:
+        ids = []
+        for key in node.files.values():
+            id = split_key(key)[0]
+            if id not in ids:
+                ids.append(id)
+        artpath = None
+        for id in ids:
+            if albums.get(id) in artpaths:
+                artpath = artpaths[albums[id]]
+                break
+        embedded = [id for id in ids if id in pictures]
+        if artpath is None and not embedded:
+            continue
+        node.cover = CoverFile(lib, index, artpath, embedded)
+        node.sorted_entries = None
+
+
+def cover_file(pathsplit):
+    """ Returns the CoverFile named by a split path, or None."""
+    if pathsplit[0] in (QUERY_DIR, CONTROL_DIR):
+        return None
+    if pathsplit[0] == RAW_DIR:
+        pathsplit = pathsplit[1:]
+    if len(pathsplit) != structure_depth:
+        return None
+    try:
+        node = directory_structure.getnode(pathsplit[:-1])
+    except KeyError:
+        return None
+    if node.cover is not None and node.cover.name() == pathsplit[-1]:
+        return node.cover
+    return None
 
-    if mapping['album'] == '':
-        mapping['album'] = 'Unknown Album'
 
-    if mapping['year'] == '0':
-        mapping['year'] = 'Unknown Year'
+def split_key(key):
+    """ Splits what the tree maps a file name to into the library id and
+        the CUE track number, which is None for anything but CUE tracks.
+    """
+    if isinstance(key, tuple):
+        return key
+    return key, None
 
-    if mapping['title'] == '':
-        mapping['title'] = 'Unknown Track'
 
-    return mapping
+def item_id(pathsplit):
+    """ Returns the library id of the file named by a split path. Raises
+        KeyError if there is no such file.
+    """
+    if pathsplit[0] == QUERY_DIR:
+        if len(pathsplit) != 3:
+            raise KeyError(pathsplit)
+        return query_cache.get(pathsplit[1]).files[pathsplit[2]]
+    if pathsplit[0] == RAW_DIR:
+        pathsplit = pathsplit[1:]
+    return (directory_structure.getnode(pathsplit[0:structure_depth-1])
+            .files[pathsplit[structure_depth-1]])
+
+
+def dir_exists(pathsplit):
+    """ Whether a split path names a directory."""
+    if pathsplit[0] == QUERY_DIR:
+        # query directories are evaluated lazily, on first lookup
+        return len(pathsplit) <= 2
+    if pathsplit[0] == CONTROL_DIR:
+        return len(pathsplit) == 1
+    if pathsplit[0] == RAW_DIR:
+        if len(pathsplit) == 1:
+            return True
+        pathsplit = pathsplit[1:]
+    return (pathsplit[len(pathsplit)-1]
+            in directory_structure.getnode(pathsplit[0:len(pathsplit)-1]).dirs)
 
 
 def mount(lib, opts, args):
@@ -125,58 +627,59 @@ def mount(lib, opts, args):
     logging.basicConfig(filename='LOG', level=logging.DEBUG)
 
     # build the in-memory folder structure
-    global structure_split
-    structure_split = PATH_FORMAT.split("/")
+    renderer = PathRenderer(PATH_FORMAT)
     global structure_depth
-    structure_depth = len(structure_split)
-    templates = {}
+    structure_depth = renderer.depth
     global library
     library = lib
 
-    # establish a blank dictionary at each level of depth
-    # also create templates for each level
-    for level in range(0, structure_depth):
-        #log.debug("Creating template %s" % structure_split[level])
-        templates[level] = Template(structure_split[level])
+    global header_index
+    header_index = open_header_index(lib)
+    if opts.warm:
+        warm(lib, header_index, [], config['workers'].get(int))
+
+    global padding_budget
+    padding_budget = config['padding_budget'].get(int)
 
     global directory_structure
-    directory_structure = FSNode({}, {})
-
-    # iterate over items in library
-    for item in list(lib.items()):
-        # build the template map
-        mapping = template_mapping(lib, item)
-
-        # do the substitutions
-        level_subbed = {}
-        for level in range(0, structure_depth):
-            level_subbed[level] = templates[level].substitute(mapping)
-
-        # build a directory structure
-        sub_elements = []
-        for level in range(0, structure_depth - 1):
-            # append the path up to the current depth, minus one, to elements
-            # this means that sub_elements contains the current path, except
-            # for the folder to be added
-            if level-1 in level_subbed:
-                sub_elements.append(level_subbed[level-1])
-            # add this directory to the master structure
-            directory_structure.adddir(sub_elements, level_subbed[level])
-
-        # add this item as a file
-
-        # First, compensate for 2 directories depth taken off above
-        # ie. sub_elements now contains the full folder path
-        sub_elements.append(level_subbed[structure_depth-3])
-        sub_elements.append(level_subbed[structure_depth-2])
-
-        # do the actual add
-        directory_structure.addfile(sub_elements,
-                                    level_subbed[structure_depth-1], item.id)
+    directory_structure = build_structure(lib, renderer)
+
+    global cue_images
+    cue_images = {}
+    if config['cue_tracks'].get(bool):
+        cue_images = add_cue_tracks(lib, renderer, header_index,
+                                    directory_structure)
+    if config['covers'].get(bool):
+        add_covers(lib, header_index, directory_structure,
+                   structure_depth - 1)
+
+    global query_cache
+    query_cache = QueryCache(lib, config['query_ttl'].get(int),
+                             config['query_cache_size'].get(int))
+
+    global item_cache
+    item_cache = ItemCache(lib, config['item_cache_size'].get(int))
+
+    global change_times
+    change_times = ChangeTimes(lib, header_index)
+
+    global negative_cache
+    negative_cache = NegativeCache(lib, config['negative_ttl'].get(int),
+                                   config['negative_cache_size'].get(int))
+
+    # found here rather than on the first statfs, which would hold up the
+    # request thread
+    global library_space
+    library_space = LibrarySpace(lib, directory_structure,
+                                 config['statfs_ttl'].get(int))
 
     server = beetFileSystem(version="%prog " + fuse.__version__,
                             usage="", dash_s_do='setsingle')
-    server.parse(errex=1)
+    server.parse(args, errex=1)
+    if 'negative_timeout' not in server.fuse_args.optdict:
+        # let the kernel remember missing names for as long as we do
+        server.fuse_args.add('negative_timeout',
+                             str(config['negative_ttl'].get(int)))
 
     server.multithreaded = 0
     try:
@@ -188,10 +691,254 @@ def mount(lib, opts, args):
 beetFs_command.func = mount
 
 
+def open_header_index(lib):
+    """ Opens the header index configured for lib; by default it sits
+        next to the library database.
+    """
+    path = config['index'].get()
+    if not path:
+        path = os.path.join(os.path.dirname(os.fsdecode(lib.path)),
+                            'beetfs.db')
+    return HeaderIndex(os.path.expanduser(path))
+
+
+def scan_layout(entry):
+    """ Process pool worker for warm(). Scans one file unless its stored
+        layout is still valid; returns (id, path, layout, error), where
+        layout is None if nothing changed.
+    """
+    id, path, stored = entry
+    try:
+        st = os.stat(path)
+        if stored == (st.st_mtime_ns, st.st_size):
+            return id, path, None, None
+        return id, path, HeaderLayout.scan(path), None
+    except (IOError, OSError, MutagenError) as e:
+        return id, path, None, str(e)
+
+
+def warm(lib, header_index, query, jobs):
+    """ Scans the headers of the FLAC items matching query across a pool
+        of jobs processes, storing new and changed layouts in the index.
+    """
+    stored = header_index.stored()
+    entries = []
+    for item in lib.items(query):
+        if path_format(item.path).lower() != "flac":
+            continue
+        known = stored.get(item.id)
+        if known is not None and known[0] != bytes(item.path):
+            known = None
+        entries.append((item.id, bytes(item.path),
+                        known[1:] if known else None))
+
+    progress = Progress(len(entries))
+    scanned = 0
+    batch = []
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for id, path, layout, error in pool.imap_unordered(scan_layout,
+                                                          entries, 64):
+            if error is not None:
+                log.error("%s: %s" % (beets.util.displayable_path(path),
+                                      error))
+            elif layout is not None:
+                batch.append((id, path, layout))
+                scanned = scanned + 1
+            if len(batch) >= 500:
+                header_index.put_many(batch)
+                batch = []
+            progress.step()
+    finally:
+        pool.close()
+        pool.join()
+    header_index.put_many(batch)
+
+    beets.ui.print_("Scanned %i of %i files in %.1f seconds "
+                    "(%.1f tracks/sec)."
+                    % (scanned, progress.total, progress.elapsed(),
+                       progress.rate()))
+
+
+def index(lib, opts, args):
+    """ Scans the headers of the matching items into the index."""
+    warm(lib, open_header_index(lib), args,
+         opts.jobs or config['workers'].get(int))
+
+
+index_command.func = index
+
+
+class Progress(object):
+    """ Prints how far a bulk job has got, about once a second."""
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def rate(self):
+        return self.done / max(self.elapsed(), 1e-6)
+
+    def step(self):
+        self.done = self.done + 1
+        now = time.time()
+        if now - self.last_report >= 1 or self.done == self.total:
+            self.last_report = now
+            beets.ui.print_("%i/%i files, %.1f tracks/sec"
+                            % (self.done, self.total, self.rate()))
+
+
+def rewrite_file(path, layout, tags, budget):
+    """ Writes a copy of the file at path with a new header and moves it
+        into place. Used when the new tags don't fit in the old header.
+    """
+    directory = os.path.dirname(path)
+    fd, temp = tempfile.mkstemp(prefix=b'.beetfs-', dir=directory)
+    try:
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+            # keep anything in front of the FLAC header (an ID3 tag)
+            target.write(source.read(layout.audio_offset
+                                     - layout.header_length))
+            target.write(layout.build(tags, source.fileno(),
+                                      layout.padding(tags, budget)))
+            source.seek(layout.audio_offset)
+            shutil.copyfileobj(source, target, 1024 * 1024)
+            target.flush()
+            os.fsync(target.fileno())
+        shutil.copymode(path, temp)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+
+def write_header(entry):
+    """ Process pool worker for write_back(). Writes tags into the header
+        of one file: in place if they fit in the space the header already
+        takes up, by rewriting the whole file otherwise. Returns (id, path,
+        outcome, layout, error), where outcome is 'unchanged', 'in place'
+        or 'rewritten' and layout is the file's new layout.
+    """
+    id, path, tags, budget = entry
+    try:
+        layout = HeaderLayout.scan(path)
+        if not layout.differs(tags):
+            return id, path, 'unchanged', layout, None
+
+        # whatever the new blocks don't use becomes padding
+        spare = layout.header_length - layout.content_size(tags) - 4
+        if 0 <= spare < 1 << 24:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                header = layout.build(tags, fd, spare)
+                os.pwrite(fd, header,
+                          layout.audio_offset - layout.header_length)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            outcome = 'in place'
+        else:
+            rewrite_file(path, layout, tags, budget)
+            outcome = 'rewritten'
+        return id, path, outcome, HeaderLayout.scan(path), None
+    except (IOError, OSError, MutagenError) as e:
+        return id, path, None, None, str(e)
+
+
+def write_back(lib, opts, args):
+    """ Writes the interpolated tags of the matching items into their
+        files, across a pool of processes. Items whose headers already
+        carry their tags, going by the index, are skipped.
+    """
+    header_index = open_header_index(lib)
+    entries = []
+    for item in lib.items(args):
+        if path_format(item.path).lower() != "flac":
+            continue
+        tags = item_tags(item)
+        try:
+            layout = header_index.get(item)
+        except OSError as e:
+            log.error("%s: %s" % (beets.util.displayable_path(item.path), e))
+            continue
+        if layout is None or layout.differs(tags):
+            entries.append((item.id, bytes(item.path), tags,
+                            config['padding_budget'].get(int)))
+
+    progress = Progress(len(entries))
+    counts = {'unchanged': 0, 'in place': 0, 'rewritten': 0, None: 0}
+    written = []
+    pool = multiprocessing.Pool(opts.jobs or config['workers'].get(int))
+    try:
+        for id, path, outcome, layout, error in pool.imap_unordered(
+                write_header, entries, 16):
+            counts[outcome] = counts[outcome] + 1
+            if error is not None:
+                log.error("%s: %s" % (beets.util.displayable_path(path),
+                                      error))
+            else:
+                written.append((id, path, outcome, layout))
+            progress.step()
+    finally:
+        pool.close()
+        pool.join()
+
+    # the files changed, so do their index entries and beets' mtimes
+    header_index.put_many([(id, path, layout)
+                           for id, path, outcome, layout in written])
+    with lib.transaction():
+        for id, path, outcome, layout in written:
+            if outcome == 'unchanged':
+                continue
+            item = lib.get_item(id)
+            item.mtime = layout.mtime / 1e9
+            item.store()
+
+    beets.ui.print_("Wrote %i files in %.1f seconds (%.1f files/sec): "
+                    "%i in place, %i needed a full rewrite, "
+                    "%i already up to date, %i failed."
+                    % (counts['in place'] + counts['rewritten'],
+                       progress.elapsed(), progress.rate(),
+                       counts['in place'], counts['rewritten'],
+                       counts['unchanged'], counts[None]))
+
+
+write_command.func = write_back
+
+
 class beetFs(BeetsPlugin):
     """ The beets plugin hook."""
+    def __init__(self):
+        super(beetFs, self).__init__()
+        self.config.add({
+            'query_ttl': 300,
+            'query_cache_size': 64,
+            'index': None,
+            'workers': multiprocessing.cpu_count(),
+            'prefetch': True,
+            'prefetch_queue': 64,
+            'prefetch_audio': 256 * 1024,
+            'max_open_files': 256,
+            'max_resident_bytes': 64 * 1024 * 1024,
+            'profile_dir': None,
+            'item_cache_size': 4096,
+            'cue_tracks': True,
+            'padding_budget': 4096,
+            'negative_ttl': 10,
+            'negative_cache_size': 4096,
+            'covers': True,
+            'statfs_ttl': 5,
+        })
+        self.register_listener('database_change', library_changed)
+        self.register_listener('cli_exit', record_changes)
+
     def commands(self):
-        return [beetFs_command]
+        return [beetFs_command, index_command, write_command]
 
 
 def to_int_be(string):
@@ -276,13 +1023,18 @@ class InterpolatedID3 (ID3):
 
 class InterpolatedFLAC (FLAC):
     def load(self, filedata):
+        """ Loads the metadata from either the bytes of a file or a file
+            object. Only the metadata blocks are read from a file object.
+        """
         self.metadata_blocks = []
         self.tags = None
         self.cuesheet = None
         self.seektable = None
         #self.filename = filename
-        self.filedata = filedata
-        self.fileobj = BytesIO(filedata)
+        if isinstance(filedata, bytes):
+            self.fileobj = BytesIO(filedata)
+        else:
+            self.fileobj = filedata
         self.__check_header(self.fileobj)
 
         while self.__read_metadata_block(self.fileobj):
@@ -329,36 +1081,6 @@ class InterpolatedFLAC (FLAC):
                     raise Exception("> 1 SeekTable block found")
         return (byte >> 7) ^ 1
 
-    def get_header(self, filename=None):
-        f = self.fileobj
-        f.seek(0)
-
-        self.__check_header(f)
-        self.__offset = self.__find_audio_offset(f)
-        data = bytearray(b'fLaC')
-
-        for block in self.metadata_blocks:
-            if isinstance(block, Padding):
-                continue
-            data += MetadataBlock._writeblock(block)
-
-        padding = Padding()
-        padding.length = 1020
-        data += MetadataBlock._writeblock(padding, is_last=True)
-
-        return bytes(data)
-
-    def offset(self):
-        return self.__offset
-
-    def __find_audio_offset(self, fileobj):
-        byte = 0x00
-        while not (byte >> 7) & 1:
-            byte = fileobj.read(1)[0]
-            size = to_int_be(fileobj.read(3))
-            fileobj.read(size)
-        return fileobj.tell()
-
     def __check_header(self, fileobj):
         size = 4
         header = fileobj.read(4)
@@ -374,13 +1096,667 @@ class InterpolatedFLAC (FLAC):
             return size
 
 
+# tags that are served from the database rather than from the file
+INTERPOLATED_TAGS = ('title', 'album', 'artist', 'genre')
+
+
+def padded_size(content, base, budget):
+    """ The size of a header whose blocks take up content bytes, where
+        base is what they take up with the file's own tags: base plus as
+        many padding budgets as it takes to fit the blocks and a padding
+        block header, and at least one. Tags can grow or shrink by up to a
+        budget without the size changing, and it only grows in whole
+        budgets, so tag edits rarely shift the audio.
+    """
+    steps = max(1, -(-(content + 4 - base) // budget))
+    return base + steps * budget
+
+
+def item_tags(item):
+    """ The interpolated tags of item, as they are in the database."""
+    return dict((tag, getattr(item, tag)) for tag in INTERPOLATED_TAGS)
+
+
+def cue_tags(item, number):
+    """ The tags of track number of the CUE image item."""
+    tags = item_tags(item)
+    tags['title'] = CUE_TITLE % number
+    tags['tracknumber'] = str(number)
+    return tags
+
+
+# metadata blocks up to this size are kept in the header index, so that
+# headers can be built without reading the file
+INLINE_BLOCK_SIZE = 4096
+
+
+def inlined(code, length):
+    """ Whether the header index keeps a copy of a block."""
+    return (code not in (Padding.code, VCFLACDict.code)
+            and length <= INLINE_BLOCK_SIZE)
+
+
+class HeaderLayout(object):
+    """ What beetFs needs to know about the header of a FLAC file: where
+        each metadata block sits, where the audio starts, and the Vorbis
+        comment (the only block whose content is rewritten). Together with
+        the item's tags that is enough to work out the synthesized header
+        and the virtual file size without reading the file again.
+
+        Small blocks (STREAMINFO, seek tables, cue sheets) are kept too,
+        as one string in block order, so usually the whole header can be
+        built from the layout alone.
+    """
+    def __init__(self, mtime, size, audio_offset, header_length, blocks,
+                 vorbis, inline):
+        self.mtime = mtime
+        self.size = size
+        self.audio_offset = audio_offset
+        self.header_length = header_length
+        # (code, offset of the block data, length) for each block
+        self.blocks = blocks
+        self.vorbis = vorbis
+        self.inline = inline
+        # offset: data of the blocks kept in inline
+        self.kept = {}
+        position = 0
+        for code, offset, length in blocks:
+            if inlined(code, length):
+                self.kept[offset] = inline[position:position + length]
+                position = position + length
+
+    @classmethod
+    def scan(cls, path):
+        """ Reads the layout of the FLAC file at path. Only the block
+            headers and the Vorbis comment are read.
+        """
+        with open(path, 'rb') as fileobj:
+            st = os.fstat(fileobj.fileno())
+            start = 0
+            header = fileobj.read(10)
+            if header[:3] == b"ID3":
+                # skip a leading ID3 tag
+                start = 10 + BitPaddedInt(header[6:10])
+                fileobj.seek(start)
+                header = fileobj.read(4)
+            if header[:4] != b"fLaC":
+                raise FLACNoHeaderError("not a valid FLAC file")
+            fileobj.seek(start + 4)
+
+            blocks = []
+            vorbis = b''
+            inline = []
+            last = False
+            while not last:
+                byte = fileobj.read(1)
+                if not byte:
+                    raise FLACNoHeaderError("file ended inside metadata")
+                code = byte[0] & 0x7F
+                last = bool(byte[0] >> 7)
+                length = to_int_be(fileobj.read(3))
+                offset = fileobj.tell()
+                if code == VCFLACDict.code:
+                    vorbis = fileobj.read(length)
+                elif inlined(code, length):
+                    inline.append(fileobj.read(length))
+                else:
+                    fileobj.seek(length, 1)
+                blocks.append((code, offset, length))
+            audio_offset = fileobj.tell()
+
+        return cls(st.st_mtime_ns, st.st_size, audio_offset,
+                   audio_offset - start, blocks, vorbis, b''.join(inline))
+
+    def matches(self, st):
+        """ Whether the layout is still valid for a file with stat st."""
+        return self.mtime == st.st_mtime_ns and self.size == st.st_size
+
+    def comment_block(self, tags):
+        """ The Vorbis comment block with tags set in it."""
+        comment = VCFLACDict(self.vorbis)
+        for tag, value in tags.items():
+            comment[tag] = value
+        return MetadataBlock._writeblock(comment)
+
+    def differs(self, tags):
+        """ Whether the file's own Vorbis comment disagrees with tags."""
+        comment = VCFLACDict(self.vorbis)
+        return any(comment.get(tag) != [str(value)]
+                   for tag, value in tags.items())
+
+    def content_size(self, tags):
+        """ The length of the header build() produces, less padding."""
+        size = 4 + len(self.comment_block(tags))
+        for code, offset, length in self.blocks:
+            if code not in (Padding.code, VCFLACDict.code):
+                size = size + 4 + length
+        return size
+
+    def header_size(self, tags, budget):
+        """ The length of the header synthesize() would produce."""
+        return padded_size(self.content_size(tags), self.content_size({}),
+                           budget)
+
+    def padding(self, tags, budget):
+        """ The padding that brings the header up to header_size()."""
+        return self.header_size(tags, budget) - self.content_size(tags) - 4
+
+    def virtual_size(self, item, budget):
+        return (self.header_size(item_tags(item), budget) + self.size
+                - self.audio_offset)
+
+    def pieces(self, tags, padding):
+        """ Lays out a header from the original blocks, minus padding,
+            with tags set in the Vorbis comment (which is added if the
+            file has none), followed by padding bytes of padding. Returns
+            it as a list of strings and, for blocks that aren't kept in
+            the layout, (offset, length) ranges of the real file.
+        """
+        pieces = []
+        data = bytearray(b'fLaC')
+        comment = self.comment_block(tags)
+        for code, offset, length in self.blocks:
+            if code == Padding.code:
+                continue
+            elif code == VCFLACDict.code:
+                data += comment
+                comment = None
+            else:
+                data += bytes([code]) + length.to_bytes(3, 'big')
+                if offset in self.kept:
+                    data += self.kept[offset]
+                else:
+                    pieces.append(bytes(data))
+                    pieces.append((offset, length))
+                    data = bytearray()
+        if comment is not None:
+            data += comment
+
+        block = Padding()
+        block.length = padding
+        data += MetadataBlock._writeblock(block, is_last=True)
+        pieces.append(bytes(data))
+        return pieces
+
+    def build(self, tags, fd, padding):
+        """ Builds the header pieces() describes, reading the blocks that
+            aren't kept in the layout from fd, a descriptor on the real
+            file.
+        """
+        return b''.join(piece if isinstance(piece, bytes)
+                        else os.pread(fd, piece[1], piece[0])
+                        for piece in self.pieces(tags, padding))
+
+    def synthesize(self, item, budget):
+        """ The Header served in place of the real one, with the tags from
+            the database, padded as header_size() describes.
+        """
+        tags = item_tags(item)
+        return Header(self.pieces(tags, self.padding(tags, budget)))
+
+
+class Header(object):
+    """ A synthesized header, held as the pieces HeaderLayout.pieces()
+        returns. Ranges of the real file (large blocks such as embedded
+        pictures) aren't read until a read reaches them, so a header can
+        be built and mostly served without opening the file.
+    """
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.size = 0
+        # bytes held in memory
+        self.resident = 0
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                self.size = self.size + len(piece)
+                self.resident = self.resident + len(piece)
+            else:
+                self.size = self.size + piece[1]
+
+    def read(self, offset, size, descriptor):
+        """ Returns up to size bytes from offset. descriptor is called for
+            a descriptor on the real file if a file range is reached.
+        """
+        data = []
+        end = offset + size
+        start = 0
+        for piece in self.pieces:
+            if start >= end:
+                break
+            length = len(piece) if isinstance(piece, bytes) else piece[1]
+            if start + length > offset:
+                low = max(offset - start, 0)
+                high = min(end - start, length)
+                if isinstance(piece, bytes):
+                    data.append(piece[low:high])
+                else:
+                    data.append(os.pread(descriptor(), high - low,
+                                         piece[0] + low))
+            start = start + length
+        return b''.join(data)
+
+
+class HeaderIndex(object):
+    """ A sidecar SQLite database of HeaderLayouts, keyed by item id.
+        Entries are checked against the file's mtime and size on lookup
+        and rescanned when they're stale.
+    """
+    def __init__(self, path):
+        self.path = path
+        # changes recorded through this connection
+        self.touches = 0
+        # (when, value) of the last look at PRAGMA data_version
+        self.data_version = None
+        # shared with the prefetch thread
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS modified ("
+            "id INTEGER PRIMARY KEY, time INTEGER, tags TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "id INTEGER PRIMARY KEY, path BLOB, mtime INTEGER, "
+            "size INTEGER, audio_offset INTEGER, header_length INTEGER, "
+            "blocks TEXT, vorbis BLOB, inline BLOB)")
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(headers)")]
+        if 'inline' not in columns:
+            # an index from before small blocks were kept; its entries
+            # are rescanned as they're used
+            self.connection.execute(
+                "ALTER TABLE headers ADD COLUMN inline BLOB")
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(modified)")]
+        if 'tags' not in columns:
+            # changes recorded before their tags were; the next change is
+            # compared with the file's own tags instead
+            self.connection.execute(
+                "ALTER TABLE modified ADD COLUMN tags TEXT")
+        self.connection.commit()
+
+    def get(self, item, st=None):
+        """ Returns the stored layout for item if it is still valid, or
+            None. st is the stat of the file, if it's already known.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, mtime, size, audio_offset, header_length, "
+                "blocks, vorbis, inline FROM headers WHERE id = ?",
+                (item.id,)).fetchone()
+        if (row is None or bytes(row[0]) != bytes(item.path)
+                or row[7] is None):
+            return None
+        layout = HeaderLayout(row[1], row[2], row[3], row[4],
+                              [tuple(block) for block in json.loads(row[5])],
+                              bytes(row[6]), bytes(row[7]))
+        if st is None:
+            st = os.stat(item.path)
+        if not layout.matches(st):
+            return None
+        return layout
+
+    def stored(self):
+        """ Returns {id: (path, mtime, size)} for every entry. Entries
+            from before small blocks were kept aren't included, so that
+            they're rescanned.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, path, mtime, size FROM headers "
+                "WHERE inline IS NOT NULL").fetchall()
+        return dict((row[0], (bytes(row[1]), row[2], row[3]))
+                    for row in rows)
+
+    def with_block(self, code):
+        """ Returns the ids of the entries with a block of type code."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, blocks FROM headers WHERE blocks LIKE ?",
+                ('%%[%i, %%' % code,)).fetchall()
+        return [row[0] for row in rows
+                if any(block[0] == code for block in json.loads(row[1]))]
+
+    def put(self, item, layout):
+        self.put_many([(item.id, item.path, layout)])
+
+    def put_many(self, entries):
+        """ Stores (id, path, layout) entries in one transaction."""
+        rows = [(id, bytes(path), layout.mtime, layout.size,
+                 layout.audio_offset, layout.header_length,
+                 json.dumps(layout.blocks), layout.vorbis, layout.inline)
+                for id, path, layout in entries]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO headers (id, path, mtime, size, "
+                "audio_offset, header_length, blocks, vorbis, inline) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def modified(self):
+        """ Returns {id: time in ns} of the recorded item changes."""
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT id, time FROM modified").fetchall())
+
+    def touch_many(self, entries):
+        """ Records (id, time in ns, tags) item changes in one transaction.
+            A change is left out if the tags are as they were at the last
+            recorded change or, failing that, as the file has them, since
+            the served header didn't change; so is one to an item that was
+            never scanned, as nothing was served for it.
+        """
+        with self.lock:
+            rows = []
+            for id, changed, tags in entries:
+                tags = dict((tag, str(value)) for tag, value in tags.items())
+                if self.served_tags(id) not in (None, tags):
+                    rows.append((id, changed, json.dumps(tags)))
+            if not rows:
+                return
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO modified (id, time, tags) "
+                "VALUES (?, ?, ?)", rows)
+            self.connection.commit()
+            self.touches = self.touches + 1
+
+    def served_tags(self, id):
+        """ The interpolated tags served for id before the change being
+            recorded, or None if it was never scanned. Called with the lock
+            held.
+        """
+        row = self.connection.execute(
+            "SELECT tags FROM modified WHERE id = ?", (id,)).fetchone()
+        if row is not None and row[0] is not None:
+            return json.loads(row[0])
+        row = self.connection.execute(
+            "SELECT vorbis FROM headers WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        if not row[0]:
+            # the file has no Vorbis comment
+            return {}
+        comment = VCFLACDict(bytes(row[0]))
+        return dict((tag, comment[tag][0]) for tag in INTERPOLATED_TAGS
+                    if len(comment.get(tag, [])) == 1)
+
+    def version(self):
+        """ A token that changes when this connection records changes or
+            another one (another beets process) writes to the index; the
+            latter is checked once per GENERATION_INTERVAL. Header layouts
+            stored through this connection don't change it.
+        """
+        now = time.monotonic()
+        if (self.data_version is None
+                or now - self.data_version[0] >= GENERATION_INTERVAL):
+            with self.lock:
+                self.data_version = (now, self.connection.execute(
+                    "PRAGMA data_version").fetchone()[0])
+        return (self.data_version[1], self.touches)
+
+    def lookup(self, item, st=None):
+        """ Returns the layout for item, scanning the file if the index
+            doesn't have a valid one.
+        """
+        layout = self.get(item, st)
+        if layout is None:
+            layout = HeaderLayout.scan(item.path)
+            self.put(item, layout)
+        return layout
+
+
+class CueImage(object):
+    """ The tracks of a FLAC image with an embedded cue sheet. Each track
+        is served as a FLAC file of its own: a synthesized header followed
+        by a run of whole frames of the image, so nothing is re-encoded.
+
+        Frame boundaries come from the seek table. A track starts at the
+        last seek point at or before its index 01 and ends where the next
+        one starts, so tracks adjoin exactly; how close that is to the cue
+        sheet depends on how dense the seek table is.
+    """
+    def __init__(self, layout, streaminfo, tracks):
+        self.layout = layout
+        self.streaminfo = streaminfo
+        # number: (samples, start, end), with byte offsets into the image
+        self.tracks = tracks
+
+    @classmethod
+    def read(cls, path, layout):
+        """ Maps the tracks of the image at path. Only STREAMINFO, the cue
+            sheet and the seek table are needed, and they're only read if
+            the layout doesn't keep them. Returns None if the image can't
+            be split into at least two tracks.
+        """
+        data = {}
+        wanted = [(code, offset, length)
+                  for code, offset, length in layout.blocks
+                  if code in (StreamInfo.code, CueSheet.code, SeekTable.code)]
+        for code, offset, length in wanted:
+            if offset in layout.kept:
+                data[code] = layout.kept[offset]
+        if len(data) < len(wanted):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                for code, offset, length in wanted:
+                    if code not in data:
+                        data[code] = os.pread(fd, length, offset)
+            finally:
+                os.close(fd)
+        if CueSheet.code not in data or SeekTable.code not in data:
+            return None
+
+        # (first sample, offset from the first frame) of each seek point
+        points = [(0, 0)]
+        for point in SeekTable(data[SeekTable.code]).seekpoints:
+            # placeholders have all bits of first_sample set
+            if 0 < point.first_sample < 0xFFFFFFFFFFFFFFFF:
+                points.append((point.first_sample, point.byte_offset))
+        samples = [point[0] for point in points]
+
+        starts = []
+        # the last track of a cue sheet is the lead-out
+        for track in CueSheet(data[CueSheet.code]).tracks[:-1]:
+            if track.type != 0:
+                # not audio
+                continue
+            start = track.start_offset
+            for index in track.indexes:
+                if index.index_number == 1:
+                    start = start + index.index_offset
+            starts.append((track.track_number,
+                           points[bisect.bisect_right(samples, start) - 1]))
+
+        info = StreamInfo(data[StreamInfo.code])
+        starts.append((None, (info.total_samples,
+                              layout.size - layout.audio_offset)))
+        tracks = OrderedDict()
+        for (number, start), (_, end) in zip(starts, starts[1:]):
+            if end[0] > start[0]:
+                tracks[number] = (end[0] - start[0],
+                                  layout.audio_offset + start[1],
+                                  layout.audio_offset + end[1])
+        if len(tracks) < 2:
+            return None
+        return cls(layout, data[StreamInfo.code], tracks)
+
+    def header(self, number, tags, budget):
+        """ The header of track number: STREAMINFO with the length of the
+            track and the image's Vorbis comment with tags set in it. The
+            image's other blocks describe the whole image and are left out.
+        """
+        info = StreamInfo(self.streaminfo)
+        info.total_samples = self.tracks[number][0]
+        # the image's checksum doesn't hold for part of it
+        info.md5_signature = 0
+        data = bytearray(b'fLaC')
+        data += MetadataBlock._writeblock(info)
+        # padded like whole files, with the image's own tags as the base
+        base = len(data) + len(self.layout.comment_block({}))
+        data += self.layout.comment_block(tags)
+
+        block = Padding()
+        block.length = padded_size(len(data), base, budget) - len(data) - 4
+        data += MetadataBlock._writeblock(block, is_last=True)
+        return bytes(data)
+
+    def size(self, number, tags, budget):
+        """ The size of track number as it is served."""
+        samples, start, end = self.tracks[number]
+        return len(self.header(number, tags, budget)) + end - start
+
+
+class CoverFile(object):
+    """ The cover file of an album directory: the album's art file if
+        beets has one, otherwise a picture embedded in one of the tracks,
+        the front cover if there is one. Embedded pictures are found once,
+        through the header index, and then read straight from where they
+        sit in the track, so serving one doesn't open the track.
+
+        The file is named after the format of the image found the first
+        time the name is needed, and keeps that name: if the image later
+        goes away, only another image of the same format replaces it.
+        Naming an embedded picture reads the start of its block, once per
+        album. If no image is found, the search isn't repeated until the
+        library changes.
+    """
+    def __init__(self, lib, index, artpath, ids):
+        self.lib = lib
+        self.index = index
+        self.artpath = artpath
+        # tracks with embedded pictures
+        self.ids = ids
+        # the image's format, once settled
+        self.format = None
+        # (path, offset, length, mtime, size) of an embedded picture
+        self.location = None
+        # the library generation of the last search that found nothing
+        self.failed = None
+
+    def name(self):
+        """ The file name, or None if the album has no usable art."""
+        if self.format is None:
+            generation = library_generation(self.lib)
+            if generation == self.failed:
+                return None
+            try:
+                self.locate()
+            except (IOError, OSError):
+                self.failed = generation
+                return None
+        return COVER_NAME % self.format
+
+    def settle(self, format_):
+        """ Whether an image of format_ can be served under the name."""
+        if self.format is None:
+            self.format = format_
+        return format_ == self.format
+
+    def locate(self):
+        """ Returns (path, offset, length, stat) of the image."""
+        unsettled = self.format is None
+        if self.artpath and self.settle(path_format(self.artpath).lower()):
+            try:
+                st = os.stat(self.artpath)
+                return self.artpath, 0, st.st_size, st
+            except OSError:
+                if unsettled:
+                    # an image that's gone doesn't settle the name
+                    self.format = None
+
+        if self.location is not None:
+            path, offset, length, mtime, size = self.location
+            st = os.stat(path)
+            if st.st_mtime_ns == mtime and st.st_size == size:
+                return path, offset, length, st
+
+        for id in self.ids:
+            item = self.lib.get_item(id)
+            if item is None:
+                continue
+            st = os.stat(item.path)
+            layout = self.index.lookup(item, st)
+            offsets = [offset for code, offset, length in layout.blocks
+                       if code == Picture.code]
+            if not offsets:
+                continue
+            fd = os.open(item.path, os.O_RDONLY)
+            try:
+                found = self.pick(fd, offsets)
+            finally:
+                os.close(fd)
+            if found is None:
+                continue
+            offset, length = found
+            self.location = (item.path, offset, length, st.st_mtime_ns,
+                             st.st_size)
+            return item.path, offset, length, st
+        raise IOError("no cover art in %s format" % self.format)
+
+    def pick(self, fd, offsets):
+        """ Returns (offset, length) of the image data of the first of the
+            PICTURE blocks at offsets in the file open on fd that can be
+            served, front covers first, or None.
+        """
+        # picture type 3 is the front cover
+        offsets = sorted(offsets, key=lambda offset: struct.unpack(
+            '>I', os.pread(fd, 4, offset))[0] != 3)
+        for offset in offsets:
+            offset, length, mime = picture_data(fd, offset)
+            # "-->" marks a link to the image rather than the image
+            if mime != '-->' and self.settle(mime_format(mime)):
+                return offset, length
+        return None
+
+
+def picture_data(fd, offset):
+    """ Returns (offset, length, MIME type) of the image data in the
+        PICTURE block whose content starts at offset in the file open on
+        fd.
+    """
+    # picture type, then the MIME type and description, each after its
+    # length; then width, height, depth and colours
+    length = struct.unpack('>I', os.pread(fd, 4, offset + 4))[0]
+    mime = os.pread(fd, length, offset + 8).decode('ascii', 'replace')
+    offset = offset + 8 + length
+    description = struct.unpack('>I', os.pread(fd, 4, offset))[0]
+    offset = offset + 4 + description + 16
+    length = struct.unpack('>I', os.pread(fd, 4, offset))[0]
+    return offset + 4, length, mime
+
+
+def mime_format(mime):
+    """ The file extension for an image of MIME type mime."""
+    format_ = mime.rpartition('/')[2].lower()
+    format_ = {'jpeg': 'jpg', '': 'jpg'}.get(format_, format_)
+    return UNSAFE_PATH_CHARS.sub('_', format_)
+
+
 class FSNode(object):
     """ A directory node. Contains directories (as a dictionary keyed
-        by directory name) and files (dictionary keyed by filename to id).
+        by directory name) and files (dictionary keyed by filename to id,
+        or to (id, track number) for the tracks of a CUE image).
     """
     def __init__(self, dirs, files):
         self.dirs = dirs
         self.files = files
+        # the CoverFile of an album directory
+        self.cover = None
+        self.sorted_entries = None
+
+    def entries(self):
+        """ Returns the node's contents as a list of (name, mode) pairs:
+            directories first, each group sorted by name. The list is built
+            once and kept until the node changes, so readdir offsets stay
+            valid across calls.
+        """
+        if self.sorted_entries is None:
+            entries = [(name, stat.S_IFDIR) for name in sorted(self.dirs)]
+            names = list(self.files)
+            if self.cover is not None and self.cover.name() is not None:
+                names.append(self.cover.name())
+            entries.extend((name, stat.S_IFREG) for name in sorted(names))
+            self.sorted_entries = entries
+        return self.sorted_entries
 
     def getnode(self, elements, root=None):
         if root is None:
@@ -401,6 +1777,7 @@ class FSNode(object):
         node = self.getnode(elements, root=root)
         if not directory in node.dirs:
             node.dirs[directory] = FSNode({}, {})
+            node.sorted_entries = None
 
     def addfile(self, elements, filename, id, root=None):
         if root is None:
@@ -409,147 +1786,730 @@ class FSNode(object):
         if len(elements) == 1 and elements[0] == '':
             elements = []
         node = self.getnode(elements, root=root)
+        filename = node.unique_name(filename, id)
         node.files[filename] = id
+        node.sorted_entries = None
+        return filename
+
+    def unique_name(self, filename, id):
+        """ Returns filename, or if another item already has that name
+            here, the first free "name (2).ext", "name (3).ext", ...
+            Items are added in id order, so the result is stable between
+            mounts.
+        """
+        n = 2
+        candidate = filename
+        while self.files.get(candidate, id) != id:
+            stem, ext = os.path.splitext(filename)
+            candidate = '%s (%d)%s' % (stem, n, ext)
+            n = n + 1
+        return candidate
+
+    def makedirs(self, elements):
+        """ Returns the node at elements, creating any missing directories
+            on the way.
+        """
+        node = self
+        for directory in elements:
+            if directory not in node.dirs:
+                node.dirs[directory] = FSNode({}, {})
+                node.sorted_entries = None
+            node = node.dirs[directory]
+        return node
+
+
+class ItemState(object):
+    """ Everything the open handles on one item share: the item itself,
+        the synthesized header and where the audio starts in the real file.
+        Never changed once built; a tag write replaces it with a new one.
+    """
+    def __init__(self, item, index):
+        self.item = item
+        self.real_path = item.path
+        self.key = item.id
 
-    def listdir(self, elements, directories, root=None):
-        if root is None:
-            root = self
-        if len(elements) == 1 and elements[0] == '':
-            elements = []
-        node = self.getnode(elements, root=root)
-        if directories:
-            return list(node.dirs.keys())
+        #TODO: This needs to handle other file formats; use mutagen's
+        #      detection procedure
+        self.format = path_format(item.path).lower()
+        if self.format == "flac":
+            # built from the index alone; blocks too large to keep there
+            # are read by the handles when they're reached
+            layout = index.lookup(item)
+            self.header = layout.synthesize(item, padding_budget)
+            self.music_offset = layout.audio_offset
+            real_size = layout.size
         else:
-            return list(node.files.keys())
+            self.header = Header([])  # disable interpolation for now
+            self.music_offset = 0  # disable interpolation for now
+            real_size = os.path.getsize(self.real_path)
+
+        self.bound = self.header.size
+        self.size = self.bound + real_size - self.music_offset
+        self.audio_end = real_size
+
+    def current(self, item):
+        """ Whether this state still matches item as it is in the
+            database.
+        """
+        return (item.path == self.item.path
+                and all(getattr(item, tag) == getattr(self.item, tag)
+                        for tag in INTERPOLATED_TAGS))
+
+
+class CueTrackState(ItemState):
+    """ The state of one track of a CUE image: its own header, in front
+        of its byte range of the image.
+    """
+    def __init__(self, item, image, number):
+        self.item = item
+        self.real_path = item.path
+        self.key = (item.id, number)
+        # tags can't be written back into part of an image
+        self.format = 'cue'
+        if not image.layout.matches(os.stat(self.real_path)):
+            raise IOError("image changed since it was mounted")
+        self.header = Header([image.header(number, cue_tags(item, number),
+                                           padding_budget)])
+        samples, self.music_offset, self.audio_end = image.tracks[number]
+        self.bound = self.header.size
+        self.size = self.bound + self.audio_end - self.music_offset
+
+
+class ItemStates(object):
+    """ The ItemState of every item that has open handles. States are
+        counted per handle and dropped with the last one, so nothing is
+        kept for files that aren't open, apart from a bounded number of
+        states the prefetcher built ahead of time.
+
+        The headers held here are kept under max_bytes: once over budget,
+        prefetched states go first, then the least recently used states of
+        open items, which are rebuilt if their handles are used again.
+    """
+    def __init__(self, lib, index, scheduler, prefetched=0, max_bytes=None):
+        self.lib = lib
+        self.index = index
+        self.scheduler = scheduler
+        self.states = OrderedDict()
+        self.counts = {}
+        self.prefetched = OrderedDict()
+        self.prefetch_size = prefetched
+        self.max_bytes = max_bytes
+        self.resident = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def build(self, key, item=None, priority=INTERACTIVE):
+        """ Builds the state for key, a library id or (id, CUE track)."""
+        id, number = split_key(key)
+        if item is None:
+            item = self.lib.get_item(id)
+        with self.scheduler.slot(priority):
+            if number is None:
+                return ItemState(item, self.index)
+            return CueTrackState(item, cue_images[id], number)
+
+    def acquire(self, key):
+        with self.lock:
+            if key not in self.counts:
+                item = self.lib.get_item(split_key(key)[0])
+                state = self.prefetched.pop(key, None)
+                if state is not None:
+                    self.resident = self.resident - state.header.resident
+                if state is None or not state.current(item):
+                    state = self.build(key, item)
+                self.counts[key] = 0
+                self.add(key, state)
+            self.counts[key] = self.counts[key] + 1
+            return self.get(key)
+
+    def get(self, key):
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                # evicted while its handles were idle
+                state = self.build(key)
+                self.add(key, state)
+            else:
+                self.states.move_to_end(key)
+            return state
+
+    def add(self, id, state):
+        old = self.states.pop(id, None)
+        if old is not None:
+            self.resident = self.resident - old.header.resident
+        self.states[id] = state
+        self.resident = self.resident + state.header.resident
+        self.trim()
+
+    def trim(self):
+        """ Evicts states, oldest first, until back under budget. The
+            most recently used state always stays.
+        """
+        if self.max_bytes is None:
+            return
+        while self.resident > self.max_bytes and self.prefetched:
+            id, state = self.prefetched.popitem(last=False)
+            self.resident = self.resident - state.header.resident
+            self.evictions = self.evictions + 1
+        while self.resident > self.max_bytes and len(self.states) > 1:
+            id, state = self.states.popitem(last=False)
+            self.resident = self.resident - state.header.resident
+            self.evictions = self.evictions + 1
+            logging.info("Evicted state for %s (%s bytes resident)"
+                         % (id, self.resident))
+
+    def release(self, id):
+        with self.lock:
+            self.counts[id] = self.counts[id] - 1
+            if self.counts[id] == 0:
+                del self.counts[id]
+                state = self.states.pop(id, None)
+                if state is not None:
+                    self.resident = self.resident - state.header.resident
+
+    def wanted(self, id):
+        """ Whether it's worth prefetching a state for id."""
+        return id not in self.counts and id not in self.prefetched
+
+    def offer(self, state):
+        """ Keeps a state built by the prefetcher for the next acquire,
+            dropping the oldest ones beyond the limit.
+        """
+        with self.lock:
+            if not self.wanted(state.key):
+                return
+            self.prefetched[state.key] = state
+            self.resident = self.resident + state.header.resident
+            while len(self.prefetched) > self.prefetch_size:
+                id, old = self.prefetched.popitem(last=False)
+                self.resident = self.resident - old.header.resident
+            self.trim()
+
+    def commit(self, item):
+        """ Stores a changed item and rebuilds its state, so every open
+            handle on it sees the new tags.
+        """
+        # beets sends database_change from here, which library_changed()
+        # picks up
+        item.store()
+        record_changes(index=self.index)
+        with self.lock:
+            # the item's CUE tracks, if it has any, change with it
+            for key in list(self.prefetched):
+                if split_key(key)[0] == item.id:
+                    old = self.prefetched.pop(key)
+                    self.resident = self.resident - old.header.resident
+            for key in list(self.counts):
+                if split_key(key)[0] == item.id:
+                    self.add(key, self.build(key, item))
+
+    def usage(self):
+        return {
+            'open_items': len(self.counts),
+            'resident_states': len(self.states),
+            'prefetched_states': len(self.prefetched),
+            'resident_bytes': self.resident,
+            'max_resident_bytes': self.max_bytes,
+            'state_evictions': self.evictions,
+        }
+
+
+class IOScheduler(object):
+    """ Orders disk work by priority class (see IO_CLASSES). Work in a
+        class only starts while nothing of a more urgent class is running
+        or waiting, so prefetching stays out of the way of requests; work
+        that has started runs to the end. Requests are handled on one
+        thread and prefetching on another, so there is nothing to limit
+        within a class. Queue depths and how long work waited and took
+        are kept per class.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = [0] * len(IO_CLASSES)
+        self.waiting = [0] * len(IO_CLASSES)
+        self.most_waiting = [0] * len(IO_CLASSES)
+        self.requests = [0] * len(IO_CLASSES)
+        self.wait_time = [0.0] * len(IO_CLASSES)
+        self.service_time = [0.0] * len(IO_CLASSES)
+
+    def ready(self, priority):
+        return not any(self.running[urgent] or self.waiting[urgent]
+                       for urgent in range(priority))
+
+    @contextmanager
+    def slot(self, priority):
+        """ Waits for a turn at work of class priority."""
+        queued = time.monotonic()
+        with self.condition:
+            self.waiting[priority] = self.waiting[priority] + 1
+            self.most_waiting[priority] = max(self.most_waiting[priority],
+                                              self.waiting[priority])
+            while not self.ready(priority):
+                self.condition.wait()
+            self.waiting[priority] = self.waiting[priority] - 1
+            self.running[priority] = self.running[priority] + 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            finished = time.monotonic()
+            with self.condition:
+                self.running[priority] = self.running[priority] - 1
+                self.requests[priority] = self.requests[priority] + 1
+                self.wait_time[priority] = (self.wait_time[priority]
+                                            + started - queued)
+                self.service_time[priority] = (self.service_time[priority]
+                                               + finished - started)
+                self.condition.notify_all()
+
+    def usage(self):
+        usage = {}
+        for priority, name in enumerate(IO_CLASSES):
+            requests = max(self.requests[priority], 1)
+            usage['io_%s_requests' % name] = self.requests[priority]
+            usage['io_%s_queued' % name] = self.waiting[priority]
+            usage['io_%s_max_queued' % name] = self.most_waiting[priority]
+            usage['io_%s_mean_wait_ms' % name] = round(
+                self.wait_time[priority] * 1000 / requests, 3)
+            usage['io_%s_mean_service_ms' % name] = round(
+                self.service_time[priority] * 1000 / requests, 3)
+        return usage
+
+
+class Descriptors(object):
+    """ Keeps the number of real files open under max_files. Handles ask
+        for their descriptor on every use; when there are too many, the
+        least recently used descriptor is closed and its handle reopens
+        the file the next time it needs it.
+    """
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.open = OrderedDict()
+        self.closed = set()
+        self.evictions = 0
+        self.reopens = 0
+        self.opens = 0
+
+    def get(self, handle):
+        fd = self.open.get(handle)
+        if fd is not None:
+            self.open.move_to_end(handle)
+            return fd
+
+        fd = os.open(handle.real_path, os.O_RDONLY)
+        self.opens = self.opens + 1
+        if handle in self.closed:
+            self.closed.discard(handle)
+            self.reopens = self.reopens + 1
+        self.open[handle] = fd
+        while len(self.open) > self.max_files:
+            victim, victim_fd = self.open.popitem(last=False)
+            os.close(victim_fd)
+            self.closed.add(victim)
+            self.evictions = self.evictions + 1
+        return fd
+
+    def close(self, handle):
+        self.closed.discard(handle)
+        fd = self.open.pop(handle, None)
+        if fd is not None:
+            os.close(fd)
+
+    def usage(self):
+        return {
+            'open_files': len(self.open),
+            'max_open_files': self.max_files,
+            'file_opens': self.opens,
+            'file_evictions': self.evictions,
+            'file_reopens': self.reopens,
+        }
 
 
 class FileHandler(object):
-    def __init__(self, path, lib):
+    """ One open() of a file, returned to FUSE as the file handle. Each
+        has its own descriptor on the real file; header and offsets come
+        from the ItemState shared with the item's other handles.
+
+        The real file is only opened once a read goes past the header, so
+        a scanner that just reads tags never opens it.
+    """
+    def __init__(self, path, states, descriptors, id):
         self.path = path
-        self.lib = lib
+        self.states = states
+        self.descriptors = descriptors
+        self.id = id
+        self.real_path = states.acquire(id).real_path
 
-        pathsplit = path[1:].split('/')
+    @property
+    def state(self):
+        return self.states.get(self.id)
 
-        # determine the item and real path
-        self.item = self.lib.get_item(id=directory_structure
-                                      .getnode(pathsplit[0:structure_depth-1])
-                                      .files[pathsplit[structure_depth-1]])
-        self.real_path = self.item.path
+    @property
+    def fd(self):
+        return self.descriptors.get(self)
 
-        # open the on-disk file for reading
-        self.file_object = open(self.real_path, 'rb')
-        self.instance_count = 1
+    def release(self):
+        self.descriptors.close(self)
+        self.states.release(self.id)
 
-        # now get the bounds of the file_class
-        #TODO: This needs to handle other file formats; use mutagen's
-        #      detection procedure
-        self.format = os.path.splitext(path)[1][1:].lower()
-        #logging.info(self.real_path)
-        if self.format == "flac":
-            #self.inf = InterpolatedFLAC(self.real_path)
-            self.inf = InterpolatedFLAC(self.file_object.read())
+    def read(self, size, offset):
+        state = self.state
+        scheduler = self.states.scheduler
+        # check if read is within header boundary
+        if offset < state.bound:
+            # large blocks of the header are read from the file too
+            with scheduler.slot(INTERACTIVE):
+                ret = state.header.read(offset, size, lambda: self.fd)
+                if len(ret) < size:
+                    # get the header + some data from file
+                    ret = ret + os.pread(self.fd,
+                                         min(size - len(ret),
+                                             state.audio_end
+                                             - state.music_offset),
+                                         state.music_offset)
+            return ret
+
+        # otherwise, pass read call to underlying file system; a CUE
+        # track ends before the image does
+        start = state.music_offset + offset - state.bound
+        with scheduler.slot(AUDIO):
+            return os.pread(self.fd,
+                            max(0, min(size, state.audio_end - start)),
+                            start)
 
-            # get values from database
-            self.inf["title"] = self.item.title
-            self.inf["album"] = self.item.album
-            self.inf["artist"] = self.item.artist
-            self.inf["genre"] = self.item.genre
+    def write(self, offset, buf):
+        state = self.state
+        # determine if offset is within header; if not, discard write
+        if offset < state.bound and state.format == "flac":
+            # patch the new data into the header; the start of the audio
+            # follows it so that the end of the metadata can be found
+            with self.states.scheduler.slot(INTERACTIVE):
+                current = state.header.read(0, state.bound,
+                                            lambda: self.fd)
+                header = (current[0:offset] + buf
+                          + current[offset + len(buf):]
+                          + os.pread(self.fd, 2, state.music_offset))
 
-            self.header = self.inf.get_header(self.real_path)
-            self.bound = len(self.header)
-            self.music_offset = self.inf.offset()
+            try:
+                inf = InterpolatedFLAC(header)
 
-        elif self.format == "mp3":
-            self.bound = 0  # disable interpolation for now
-            self.music_offset = 0  # disable interpolation for now
+                # instead of putting the values into the FLAC, extract the
+                # values
+                item = self.states.lib.get_item(self.id)
+                for tag in INTERPOLATED_TAGS:
+                    setattr(item, tag, str(inf[tag][0]))
+                self.states.commit(item)
 
-        # read in the contents of the file
-        self.file_object.seek(self.music_offset)
-        self.music_data = self.file_object.read()
-        # close the file
-        self.file_object.close()
+                return len(buf)
+            except IOError:
+                logging.error("Couldn't update tag.")
 
-    def open(self):
-        # as init() handles actual opening, just increment instance count here
-        self.instance_count = self.instance_count + 1
 
-    def release(self):
-        # decrement the instance count
-        if self.instance_count > 0:
-            self.instance_count = self.instance_count - 1
-            return False
-        else:
-            return True
+class RawHandler(object):
+    """ A handle on a file in /.raw/: reads go straight to the real file,
+        with nothing interpolated and nothing buffered.
+    """
+    def __init__(self, path, descriptors, real_path):
+        self.path = path
+        self.descriptors = descriptors
+        self.real_path = real_path
+        # open the on-disk file for reading
+        descriptors.get(self)
 
     def read(self, size, offset):
-        # check if read is within header boundary
-        if offset < self.bound:
-            if offset + size < len(self.header):
-                # can just read from header
-                logging.info("JUST HEADER")
-                ret = self.header[offset:offset+size]
-                return ret
-            else:
-                # get the header + some data from file
-                logging.info("HEADER + DATA")
-                ret = self.header[offset:len(self.header)]
-                ret = ret + self.music_data[0:size - ((len(self.header)
-                                                       - offset))]
-                return ret
-
-        # otherwise, pass read call to underlying file system
-        #self.file_object.seek(offset)
-        logging.info("JUST MUSIC")
-        return self.music_data[offset - len(self.header):offset
-                               - len(self.header) + size]
+        return os.pread(self.descriptors.get(self), size, offset)
 
     def write(self, offset, buf):
-        # determine if offset is within header; if not, discard write
+        return -errno.EROFS
+
+    def release(self):
+        self.descriptors.close(self)
 
-        if offset < self.bound:
-            # load interpolated file into memory
 
-            filedata = self.header + self.music_data
+class CoverHandler(RawHandler):
+    """ A handle on a cover file: the whole of an art file, or just the
+        image data of a picture embedded in a track.
+    """
+    def __init__(self, path, descriptors, location):
+        real_path, self.start, self.length, st = location
+        super(CoverHandler, self).__init__(path, descriptors, real_path)
+
+    def read(self, size, offset):
+        size = max(0, min(size, self.length - offset))
+        return os.pread(self.descriptors.get(self), size, self.start + offset)
 
-            # patch in the new data
-            filedata2 = filedata[0:offset] + buf + filedata[offset + len(buf):]
-            filedata = filedata2
 
-            # create a new normal mutagen object
-            if self.format == "flac":
+class Prefetcher(object):
+    """ Prepares the tracks of an album in a background thread once its
+        directory is opened, since the tracks are usually opened in turn
+        right after. Header states are handed to ItemStates and the start
+        of the audio is read ahead into the page cache.
+
+        The queue is bounded, and opening another album cancels whatever
+        is still queued for the previous one, so skimming through many
+        albums doesn't pile up disk work.
+    """
+    def __init__(self, lib, states, size, audio):
+        self.lib = lib
+        self.states = states
+        self.audio = audio
+        self.queue = queue.Queue(size)
+        self.generation = 0
+        self.thread = threading.Thread(target=self.run, name='prefetch')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def album(self, node):
+        """ Queues the files of an album directory, cancelling earlier
+            albums.
+        """
+        self.generation = self.generation + 1
+        # make room by dropping what's still queued for earlier albums;
+        # anything the thread has already taken is skipped by generation
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        for name, mode in node.entries():
+            if name not in node.files:
+                continue
+            try:
+                self.queue.put_nowait((self.generation, node.files[name]))
+            except queue.Full:
+                break
+
+    def run(self):
+        while True:
+            generation, id = self.queue.get()
+            if generation != self.generation:
+                # a later album was opened
+                continue
+            try:
+                self.prefetch(id)
+            except Exception as e:
+                logging.info("Prefetch failed for %s: %s" % (id, e))
+
+    def prefetch(self, id):
+        if not self.states.wanted(id):
+            return
+        state = self.states.build(id, priority=BACKGROUND)
+        self.states.offer(state)
+        if self.audio:
+            with self.states.scheduler.slot(BACKGROUND):
+                fd = os.open(state.real_path, os.O_RDONLY)
                 try:
-                    # now obtain a new Interpolated FLAC from the temporary
-                    # file
-                    self.inf = InterpolatedFLAC(filedata)
-
-                    # instead of putting the values into the FLAC, extract the
-                    # values
-                    self.item.title = (str(self.inf["title"][0])
-                                       .encode('utf-8'))
-                    self.item.album = (str(self.inf["album"][0])
-                                       .encode('utf-8'))
-                    self.item.artist = (str(self.inf["artist"][0])
-                                        .encode('utf-8'))
-                    self.item.genre = (str(self.inf["genre"][0])
-                                       .encode('utf-8'))
-
-                    self.lib.store(self.item)
-                    self.lib.save()
-
-                    # get values from database
-                    self.inf["title"] = self.item.title
-                    self.inf["album"] = self.item.album
-                    self.inf["artist"] = self.item.artist
-                    self.inf["genre"] = self.item.genre
-
-                    self.header = self.inf.get_header(self.real_path)
-                    self.bound = len(self.header)
-                    self.music_offset = self.inf.offset()
-
-                    return len(buf)
-                except IOError:
-                    logging.error("Couldn't update tag.")
-            pass
+                    os.posix_fadvise(fd, state.music_offset, self.audio,
+                                     os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+
+
+class VirtualFile(object):
+    """ A read-only handle on generated contents, like /.beetfs/stats. The
+        contents are fixed when the file is opened and don't match the size
+        getattr gave, so reads bypass the page cache.
+    """
+    direct_io = True
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size, offset):
+        return self.data[offset:offset+size]
+
+    def write(self, offset, buf):
+        return -errno.EACCES
+
+    def release(self):
+        pass
+
+
+class ControlFile(VirtualFile):
+    """ A handle on /.beetfs/control. Every line written to it is run as
+        a Profiler command; reading it gives back what the commands said.
+    """
+    def __init__(self, profiler):
+        super(ControlFile, self).__init__(b'')
+        self.profiler = profiler
+
+    def write(self, offset, buf):
+        output = []
+        for line in buf.decode('utf-8', 'replace').splitlines():
+            if line.strip():
+                output.append(self.profiler.command(line.split()))
+        self.data = self.data + ''.join(line + '\n'
+                                        for line in output).encode('utf-8')
+        return len(buf)
+
+
+class Profiler(object):
+    """ Profiling for a running mount, driven through /.beetfs/control:
+
+        profile start      start cProfile on the FUSE request thread
+        profile stop       stop it and dump the stats
+        memory start       start tracing allocations with tracemalloc
+        memory snapshot    dump a snapshot, with a summary of the biggest
+                           allocation sites and of the tree, caches and
+                           handles
+        memory stop        stop tracing
+
+        Results go to directory. Nothing is hooked in until a command
+        asks for it.
+    """
+    COMMANDS = ('profile_start', 'profile_stop', 'memory_start',
+                'memory_snapshot', 'memory_stop')
+
+    def __init__(self, directory, fs):
+        self.directory = directory
+        self.fs = fs
+        self.profile = None
+
+    def output(self, suffix):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        return os.path.join(self.directory, time.strftime(
+            'beetfs-%Y%m%d-%H%M%S') + suffix)
+
+    def command(self, words):
+        logging.info("control: %s" % ' '.join(words))
+        name = '_'.join(words)
+        if name not in self.COMMANDS:
+            return "unknown command: %s" % ' '.join(words)
+        return getattr(self, name)()
+
+    def profile_start(self):
+        if self.profile is not None:
+            return "already profiling"
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return "profiling"
+
+    def profile_stop(self):
+        if self.profile is None:
+            return "not profiling"
+        self.profile.disable()
+        path = self.output('.prof')
+        self.profile.dump_stats(path)
+        self.profile = None
+        return "profile written to %s" % path
+
+    def memory_start(self):
+        tracemalloc.start()
+        return "tracing allocations"
+
+    def memory_snapshot(self):
+        if not tracemalloc.is_tracing():
+            return "not tracing allocations"
+        snapshot = tracemalloc.take_snapshot()
+        path = self.output('.tracemalloc')
+        snapshot.dump(path)
+        with open(path + '.txt', 'w') as summary:
+            for key, value in sorted(self.fs.usage().items()):
+                summary.write("%s: %s\n" % (key, value))
+            summary.write("\n")
+            for statistic in snapshot.statistics('lineno')[:50]:
+                summary.write("%s\n" % statistic)
+        return "snapshot written to %s" % path
+
+    def memory_stop(self):
+        tracemalloc.stop()
+        return "stopped tracing allocations"
+
+
+class LibrarySpace(object):
+    """ What statfs reports: the space on the filesystems that hold the
+        library's files, added up across devices, and the number of files
+        and directories in the tree. The devices are found when the mount
+        is set up and looked for again, among directories not seen
+        before, when the library changes. The totals are kept for ttl
+        seconds, since some desktops ask very often.
+    """
+    # the unit the totals are given in
+    BLOCK_SIZE = 4096
+
+    def __init__(self, lib, root, ttl):
+        self.lib = lib
+        self.ttl = ttl
+        # st_dev: a directory on that device
+        self.devices = {}
+        # the directories holding items that were already looked at
+        self.directories = set()
+        self.generation = library_generation(lib)
+        self.find_devices()
+        self.entries, self.covers = self.count_entries(root)
+        self.result = None
+        self.expires = 0
+
+    def find_devices(self):
+        """ Adds the devices of the directories items are in that haven't
+            been looked at yet.
+        """
+        base = os.fsencode(self.lib.directory)
+        directories = set([base])
+        with self.lib.transaction() as tx:
+            for row in tx.query("SELECT path FROM items"):
+                directories.add(os.path.dirname(
+                    os.path.join(base, os.fsencode(row[0]))))
+        for directory in directories - self.directories:
+            try:
+                self.devices.setdefault(os.stat(directory).st_dev,
+                                        directory)
+            except OSError:
+                continue
+            self.directories.add(directory)
+
+    def count_entries(self, root):
+        """ Returns the number of files and directories in the tree, not
+            counting cover files, and the CoverFiles.
+        """
+        entries = 0
+        covers = []
+        nodes = [root]
+        while nodes:
+            node = nodes.pop()
+            entries = entries + len(node.dirs) + len(node.files)
+            if node.cover is not None:
+                covers.append(node.cover)
+            nodes.extend(node.dirs.values())
+        return entries, covers
+
+    def statfs(self):
+        now = time.monotonic()
+        if self.result is not None and now < self.expires:
+            return self.result
+        generation = library_generation(self.lib)
+        if generation != self.generation:
+            self.find_devices()
+            self.generation = generation
+
+        blocks = free = available = 0
+        for directory in self.devices.values():
+            try:
+                st = os.statvfs(directory)
+            except OSError:
+                continue
+            blocks = blocks + st.f_blocks * st.f_frsize // self.BLOCK_SIZE
+            free = free + st.f_bfree * st.f_frsize // self.BLOCK_SIZE
+            available = (available
+                         + st.f_bavail * st.f_frsize // self.BLOCK_SIZE)
+        # covers count once they have a name, which listing their album
+        # gives them
+        files = self.entries + sum(1 for cover in self.covers
+                                   if cover.format)
+        # nothing can be created here, but no free inodes would make df -i
+        # report the mount as full
+        self.result = fuse.StatVfs(f_bsize=self.BLOCK_SIZE,
+                                   f_frsize=self.BLOCK_SIZE,
+                                   f_blocks=blocks, f_bfree=free,
+                                   f_bavail=available,
+                                   f_files=files, f_ffree=files,
+                                   f_favail=files, f_namemax=255)
+        self.expires = now + self.ttl
+        return self.result
+
+    def usage(self):
+        return {'statfs_devices': len(self.devices)}
 
 
 class Stat(fuse.Stat):
@@ -615,19 +2575,53 @@ class beetFileSystem(fuse.Fuse):
         # called after filesystem is mounted
         #self.lib = self.cmdline[1][0]
         self.lib = library
-        self.files = {}
+        self.descriptors = Descriptors(config['max_open_files'].get(int))
+        self.scheduler = IOScheduler()
+        prefetch = config['prefetch'].get(bool)
+        size = config['prefetch_queue'].get(int)
+        self.states = ItemStates(self.lib, header_index, self.scheduler,
+                                 size if prefetch else 0,
+                                 config['max_resident_bytes'].get(int))
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = Prefetcher(self.lib, self.states, size,
+                                         config['prefetch_audio'].get(int))
+
+        profile_dir = config['profile_dir'].get()
+        if not profile_dir:
+            profile_dir = os.path.join(tempfile.gettempdir(), 'beetfs')
+        self.profiler = Profiler(os.path.expanduser(profile_dir), self)
+        self.space = library_space
 
         logging.info("Filesystem mounted")
 
     def fsdestroy(self):
         logging.info("Unmounting file system")
+        logging.info("Resource usage: %s" % self.usage())
+
+    def usage(self):
+        """ Current use of descriptors, resident state and caches."""
+        usage = self.descriptors.usage()
+        usage.update(self.states.usage())
+        usage.update(self.scheduler.usage())
+        usage.update(self.space.usage())
+        usage['cached_queries'] = len(query_cache.entries)
+        usage.update(negative_cache.usage())
+        usage['profiling'] = self.profiler.profile is not None
+        usage['tracing_allocations'] = tracemalloc.is_tracing()
+        return usage
+
+    def control_file(self, name):
+        """ Opens one of the files in /.beetfs/."""
+        if name == 'control':
+            return ControlFile(self.profiler)
+        return VirtualFile(''.join(
+            "%s: %s\n" % (key, value)
+            for key, value in sorted(self.usage().items())).encode('utf-8'))
 
     def statfs(self):
         logging.info("statfs")
-
-        # have no way of knowing where the music is stored
-        # (disparate locations), so using homedir to fill this in
-        return os.statvfs(os.path.expanduser("~"))
+        return self.space.statfs()
 
     def getattr(self, path):
         logging.info("getattr: %s" % path)
@@ -638,46 +2632,96 @@ class beetFileSystem(fuse.Fuse):
                 mode = stat.S_IFDIR | 0o755
                 st = Stat(st_mode=mode, st_size=Stat.DIRSIZE, st_nlink=2)
                 return st
+            elif negative_cache.get(path):
+                return -errno.ENOENT
             else:
                 # determine if it's a directory or a file list
                 # Split path into components
                 pathsplit = path[1:].split('/')
 
-                if len(pathsplit) == structure_depth:
+                if pathsplit[0] == CONTROL_DIR:
+                    if len(pathsplit) == 1:
+                        return Stat(st_mode=stat.S_IFDIR | 0o755,
+                                    st_size=Stat.DIRSIZE, st_nlink=2)
+                    if len(pathsplit) > 2 or pathsplit[1] not in CONTROL_FILES:
+                        negative_cache.add(path)
+                        return -errno.ENOENT
+                    # the handles are direct_io, so the sizes are only a
+                    # rough guide
+                    if pathsplit[1] == 'control':
+                        return Stat(st_mode=stat.S_IFREG | 0o644, st_size=0)
+                    return Stat(st_mode=stat.S_IFREG | 0o444,
+                                st_size=len(self.control_file('stats')
+                                            .data))
+
+                cover = cover_file(pathsplit)
+                if cover is not None:
+                    real_path, offset, length, statinfo = cover.locate()
+                    return Stat(st_mode=stat.S_IFREG | 0o444,
+                                st_size=length,
+                                st_uid=statinfo.st_uid,
+                                st_gid=statinfo.st_gid,
+                                dt_atime=(datetime.datetime
+                                          .fromtimestamp(statinfo.st_atime)),
+                                dt_mtime=(datetime.datetime
+                                          .fromtimestamp(statinfo.st_mtime)),
+                                dt_ctime=(datetime.datetime
+                                          .fromtimestamp(statinfo.st_ctime)))
+
+                if is_file(pathsplit):
                     # it's a file
-                    item = self.lib.get_item(directory_structure
-                               .getnode(pathsplit[0:structure_depth-1])
-                               .files[pathsplit[structure_depth-1]]).path
+                    id, number = split_key(item_id(pathsplit))
+                    item = item_cache.get(id)
 
-                    if not item:
+                    if (item is None or not item.path
+                            or (number is not None
+                                and pathsplit[0] == RAW_DIR)):
                         # file not found
-                        logging.error("Returning ENOENT")
-                        return -errno.ENOENT
-                    elif item == '':
-                        logging.error("Returning ENOENT")
+                        logging.info("Returning ENOENT")
+                        negative_cache.add(path)
                         return -errno.ENOENT
-                    statinfo = os.stat(item)
+                    statinfo = os.stat(item.path)
+                    size = statinfo.st_size
+                    mtime = statinfo.st_mtime
+                    ctime = statinfo.st_ctime
+                    if pathsplit[0] != RAW_DIR:
+                        # tag changes in the database count as changes to
+                        # the file, so scanners pick them up
+                        changed = change_times.get(id)
+                        if changed is not None:
+                            mtime = max(mtime, changed)
+                            ctime = max(ctime, changed)
+                    if number is not None:
+                        size = cue_images[id].size(number,
+                                                   cue_tags(item, number),
+                                                   padding_budget)
+                    elif (pathsplit[0] != RAW_DIR
+                            and path_format(item.path).lower() == "flac"):
+                        # the size of the file as served, worked out from
+                        # the index rather than the file
+                        with self.scheduler.slot(INTERACTIVE):
+                            layout = header_index.lookup(item, statinfo)
+                        size = layout.virtual_size(item, padding_budget)
                     st = Stat(st_mode=statinfo.st_mode,
-                              st_size=statinfo.st_size,
+                              st_size=size,
                               st_uid=statinfo.st_uid,
                               st_gid=statinfo.st_gid,
                               st_nlink=statinfo.st_nlink,
                               dt_atime=(datetime.datetime
                                         .fromtimestamp(statinfo.st_atime)),
                               dt_mtime=(datetime.datetime
-                                        .fromtimestamp(statinfo.st_mtime)),
+                                        .fromtimestamp(mtime)),
                               dt_ctime=(datetime.datetime
-                                        .fromtimestamp(statinfo.st_ctime))
+                                        .fromtimestamp(ctime))
                               )
                     return st
                 else:
                     logging.info("dir")
                     # it's a directory
-                    if not (pathsplit[len(pathsplit)-1]
-                            in (directory_structure
-                                .getnode(pathsplit[0:len(pathsplit)-1]).dirs)):
+                    if not dir_exists(pathsplit):
                         # directory not found
-                        logging.error("Returning ENOENT")
+                        logging.info("Returning ENOENT")
+                        negative_cache.add(path)
                         return -errno.ENOENT
                     else:
                         logging.info("gotdir")
@@ -686,6 +2730,11 @@ class beetFileSystem(fuse.Fuse):
                                   st_nlink=2)
                         return st
 
+        except KeyError:
+            # no such name in the tree, the usual result of a probe
+            logging.info("Returning ENOENT")
+            negative_cache.add(path)
+            return -errno.ENOENT
         except Exception as e:
             logging.error(e)
             return -errno.ENOENT
@@ -709,22 +2758,26 @@ class beetFileSystem(fuse.Fuse):
         pathsplit = path[1:].split('/')
         if path == "/":
             return 0
+        elif pathsplit[0] == CONTROL_DIR:
+            if len(pathsplit) == 1 or (len(pathsplit) == 2
+                                       and pathsplit[1] in CONTROL_FILES):
+                return 0
+            return -errno.EACCES
+        elif cover_file(pathsplit) is not None:
+            return 0
         else:
-            is_dir = not len(pathsplit) == structure_depth
+            is_dir = not is_file(pathsplit)
 
         # check for existence
         if is_dir:
             logging.info("dir")
-            if not (pathsplit[len(pathsplit) - 1] in directory_structure
-                    .getnode(pathsplit[0:len(pathsplit)-1]).dirs):
+            if not dir_exists(pathsplit):
                 return -errno.EACCES
             else:
                 # if exists, always return allowed for directories
                 return 0
         else:
-            item = self.lib.get_item(id=directory_structure
-                                     .getnode(pathsplit[0:structure_depth-1])
-                                     .files[pathsplit[structure_depth-1]]).path
+            item = item_cache.get(split_key(item_id(pathsplit))[0]).path
             if not item:
                 return -errno.EACCES
             else:
@@ -739,6 +2792,96 @@ class beetFileSystem(fuse.Fuse):
 
                 return 0
 
+    def xattr_item(self, path):
+        """ The item behind a file, for its extended attributes, or None
+            if path isn't a track.
+        """
+        pathsplit = path[1:].split('/')
+        if (path == "/" or pathsplit[0] == CONTROL_DIR
+                or not is_file(pathsplit)):
+            return None
+        try:
+            return item_cache.get(split_key(item_id(pathsplit))[0])
+        except KeyError:
+            return None
+
+    def getxattr(self, path, name, size):
+        """
+        Gets a beets field of a track, as the attribute user.beets.<field>.
+        Values come from the database, not from the file.
+        size: The size of the caller's buffer; if 0, just return the length
+        of the value.
+        """
+        logging.info("getxattr: %s (name %s, size %s)" % (path, name, size))
+        item = self.xattr_item(path)
+        field = name[len(XATTR_PREFIX):]
+        if (item is None or not name.startswith(XATTR_PREFIX)
+                or field not in METADATA_TYPES):
+            return -errno.ENODATA
+        value = str(getattr(item, field))
+        if size == 0:
+            return len(value.encode('utf-8'))
+        return value
+
+    def listxattr(self, path, size):
+        """
+        Lists the beets fields available as attributes of a track.
+        size: As for getxattr; if 0, return the space the names need.
+        """
+        logging.info("listxattr: %s (size %s)" % (path, size))
+        if self.xattr_item(path) is None:
+            names = []
+        else:
+            names = [XATTR_PREFIX + key for key in METADATA_KEYS]
+        if size == 0:
+            # each name is NUL-terminated
+            return sum(len(name) + 1 for name in names)
+        return names
+
+    def setxattr(self, path, name, val, flags):
+        """
+        Sets a writable beets field of a track. The change is committed to
+        the database the same way a tag written into the header is.
+        """
+        logging.info("setxattr: %s (name %s)" % (path, name))
+        field = name[len(XATTR_PREFIX):]
+        if self.xattr_item(path) is None:
+            return -errno.ENOTSUP
+        if not name.startswith(XATTR_PREFIX) or field not in METADATA_TYPES:
+            return -errno.ENOTSUP
+        if field not in METADATA_RW_KEYS:
+            return -errno.EACCES
+        if flags & os.XATTR_CREATE:
+            # every field always exists
+            return -errno.EEXIST
+
+        if isinstance(val, bytes):
+            val = val.decode('utf-8')
+        try:
+            if METADATA_TYPES[field] == 'int':
+                value = int(val or 0)
+            elif METADATA_TYPES[field] == 'bool':
+                value = val.strip().lower() in ('1', 'true', 'yes')
+            else:
+                value = val
+        except ValueError:
+            return -errno.EINVAL
+
+        # a fresh copy; the cached item is shared
+        item = self.lib.get_item(self.xattr_item(path).id)
+        setattr(item, field, value)
+        try:
+            self.states.commit(item)
+        except Exception as e:
+            logging.error("Couldn't store %s: %s" % (name, e))
+            return -errno.EIO
+        return 0
+
+    def removexattr(self, path, name):
+        """ Fields can be changed but not removed."""
+        logging.info("removexattr: %s (name %s)" % (path, name))
+        return -errno.ENOTSUP
+
     def readlink(self, path):
         """
         Get the target of a symlink.
@@ -862,6 +3005,9 @@ class beetFileSystem(fuse.Fuse):
         null bytes.
         """
         logging.info("truncate: %s (size %s)" % (path, size))
+        if path == '/%s/control' % CONTROL_DIR:
+            # shells truncate before writing a command to it
+            return 0
         return -errno.EOPNOTSUPP
 
     ### DIRECTORY OPERATION METHODS ###
@@ -890,15 +3036,23 @@ class beetFileSystem(fuse.Fuse):
         pathsplit = path[1:].split('/')
         if path == "/":
             return directory_structure
+        elif pathsplit[0] in (QUERY_DIR, CONTROL_DIR, RAW_DIR):
+            if not dir_exists(pathsplit):
+                return -errno.EACCES
+            # the listing itself is fetched by readdir
+            return None
         else:
-            if not (pathsplit[len(pathsplit) - 1]
-                    in directory_structure
-                    .getnode(pathsplit[0:len(pathsplit)-1]).dirs):
+            if not dir_exists(pathsplit):
                 return -errno.EACCES
             else:
-                return (directory_structure
+                node = (directory_structure
                         .getnode(pathsplit[0:len(pathsplit)-1])
                         .dirs[pathsplit[len(pathsplit) - 1]])
+                if (self.prefetcher is not None
+                        and len(pathsplit) == structure_depth - 1):
+                    # an album; its tracks are likely to be opened next
+                    self.prefetcher.album(node)
+                return node
 
     def releasedir(self, path, dh=None):
         """ Closes an open directory. Allows filesystem to clean up."""
@@ -920,40 +3074,47 @@ class beetFileSystem(fuse.Fuse):
         Should yield nothing if the file is not a directory or does not
         exist. (Does not need to raise an error).
 
-        offset: I don't know what this does, but I think it allows the OS
-        to request starting the listing partway through (which I clearly
-        don't yet support). Seems to always be 0 anyway.
+        offset: Where to resume the listing. Every entry is yielded with
+        its own offset (its position in the listing plus one), which the
+        kernel hands back to continue a listing that did not fit in one
+        buffer. Listings are kept in a stable order, so resuming is a
+        matter of indexing into the cached entry list.
         """
         logging.info("readdir: %s (offset %s, dh %s)" % (path, offset, dh))
 
-        yield fuse.Direntry(".")
-        yield fuse.Direntry("..")
-
         try:
             pathsplit = path[1:].split('/')
 
-            if dh is None:
-                if path == "/":
-                    logging.info("dh assigned as root")
-                    dh = directory_structure
+            if pathsplit[0] == CONTROL_DIR:
+                entries = [(name, stat.S_IFREG) for name in CONTROL_FILES]
+            elif pathsplit[0] == RAW_DIR:
+                node = directory_structure.getnode(pathsplit[1:])
+                # CUE tracks have no file of their own to mirror
+                entries = [(name, mode) for name, mode in node.entries()
+                           if not isinstance(node.files.get(name), tuple)]
+            elif pathsplit[0] == QUERY_DIR:
+                if len(pathsplit) == 1:
+                    # the queries that are currently cached
+                    entries = [(name, stat.S_IFDIR)
+                               for name in query_cache.queries()]
                 else:
-                    dh = (directory_structure
-                          .getnode(pathsplit[0:len(pathsplit)-1])
-                          .dirs[pathsplit[len(pathsplit)]])
-
-            if len(pathsplit) == structure_depth - 1:
-                # files
-                logging.info("Yielding files: %s" % path)
-                for files in directory_structure.listdir(pathsplit, False):
-                    logging.info("Yielding file: %s"
-                                 % files.encode('utf-8'))
-                    yield fuse.Direntry(files)
+                    entries = query_cache.get(pathsplit[1]).entries()
             else:
-                # directories
-                for files in directory_structure.listdir(pathsplit, True):
-                    #logging.info("Yielding dir: %s"
-                    #             % files.encode('utf-8'))
-                    yield fuse.Direntry(files)
+                if dh is None:
+                    if path == "/":
+                        logging.info("dh assigned as root")
+                        dh = directory_structure
+                    else:
+                        dh = directory_structure.getnode(pathsplit)
+                entries = dh.entries()
+
+            # "." and ".." take the first two offsets
+            for index in range(offset, len(entries) + 2):
+                if index < 2:
+                    name, mode = ("." if index == 0 else ".."), stat.S_IFDIR
+                else:
+                    name, mode = entries[index - 2]
+                yield fuse.Direntry(name, offset=index + 1, type=mode)
 
         except Exception as e:
             logging.error(e)
@@ -986,20 +3147,25 @@ class beetFileSystem(fuse.Fuse):
         logging.info("open: %s (flags %s)" % (path, oct(flags)))
 
         try:
-            if self.files is None:
-                self.files = {"x": "y"}
-
-            if path in self.files:
-                # get a file object
-                logging.info("Retrieving an existing File Handler for: %s"
-                             % path)
-                self.files[path].open()
-            else:
-                # create a file open
-                logging.info("Creating a File Handler for: %s" % path)
-                self.files[path] = FileHandler(path, self.lib)
-
-            return self.files[path]
+            pathsplit = path[1:].split('/')
+            if pathsplit[0] == CONTROL_DIR:
+                if len(pathsplit) != 2 or pathsplit[1] not in CONTROL_FILES:
+                    return -errno.ENOENT
+                return self.control_file(pathsplit[1])
+            cover = cover_file(pathsplit)
+            if cover is not None:
+                return CoverHandler(path, self.descriptors,
+                                    cover.locate())
+            if pathsplit[0] == RAW_DIR:
+                id, number = split_key(item_id(pathsplit))
+                if number is not None:
+                    return -errno.ENOENT
+                item = item_cache.get(id)
+                return RawHandler(path, self.descriptors, item.path)
+
+            logging.info("Creating a File Handler for: %s" % path)
+            return FileHandler(path, self.states, self.descriptors,
+                               item_id(path[1:].split('/')))
         except Exception as e:
             logging.info("Error creating a File Handler", exc_info=True)
             return -errno.EACCES
@@ -1037,10 +3203,8 @@ class beetFileSystem(fuse.Fuse):
         """
         logging.info("release: %s (flags %s, fh %s)" % (path, oct(flags),
                                                         fh))
-        if self.files[path].release():
-            logging.info("Complete release: %s (flags %s, fh %s)"
-                         % (path, oct(flags), fh))
-            del self.files[path]
+        if fh is not None:
+            fh.release()
 
     def fsync(self, path, datasync, fh=None):
         """
@@ -1080,14 +3244,16 @@ class beetFileSystem(fuse.Fuse):
                      % (path, size, offset, fh))
 
         if fh is None:
-            try:
-                if self.files is None:
-                    self.files = {"x": "y"}
-                self.files[path] = FileHandler(path, self.lib)
-            except:
+            # no handle from open; use one just for this call
+            fh = self.open(path, os.O_RDONLY)
+            if isinstance(fh, int):
                 return -errno.EPERM
+            try:
+                return fh.read(size, offset)
+            finally:
+                fh.release()
 
-        return self.files[path].read(size, offset)
+        return fh.read(size, offset)
 
     def write(self, path, buf, offset, fh=None):
         """
@@ -1106,15 +3272,19 @@ class beetFileSystem(fuse.Fuse):
         logging.info("write: %s (offset %s, fh %s)" % (path, offset, fh))
 
         if fh is None:
-            try:
-                if self.files is None:
-                    self.files = {"x": "y"}
-                self.files[path] = FileHandler(path, self.lib)
-            except:
+            # no handle from open; use one just for this call
+            fh = self.open(path, os.O_RDWR)
+            if isinstance(fh, int):
                 return -errno.EPERM
+            try:
+                return fh.write(offset, buf)
+            except Exception as ex:
+                logging.info(ex)
+            finally:
+                fh.release()
 
         try:
-            return self.files[path].write(offset, buf)
+            return fh.write(offset, buf)
         except Exception as ex:
             logging.info(ex)
 
@@ -0,0 +1,77 @@
+""" Small FLAC files and libraries for the tests. The files have real
+    metadata blocks and a run of bytes standing in for the audio frames,
+    which is all beetFs looks at.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from beets.library import Item, Library
+from mutagen.flac import VCFLACDict
+
+
+def block(code, data, last=False):
+    """ A metadata block of type code holding data."""
+    return (struct.pack('>B', code | (0x80 if last else 0))
+            + len(data).to_bytes(3, 'big') + data)
+
+
+def stream_info(samples=441000):
+    """ STREAMINFO for 4096-sample blocks, 44.1 kHz, stereo, 16 bits."""
+    return (struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+            + ((44100 << 44) | (1 << 41) | (15 << 36) | samples)
+            .to_bytes(8, 'big') + b'\x00' * 16)
+
+
+def comment(tags):
+    """ The content of a Vorbis comment block with tags in it."""
+    vorbis = VCFLACDict()
+    for tag, value in tags.items():
+        vorbis[tag] = value
+    return vorbis.write()
+
+
+def make_flac(path, tags, blocks=(), padding=512, audio=None):
+    """ Writes a FLAC file to path: STREAMINFO, a Vorbis comment with
+        tags, blocks (code, data), padding bytes of padding and audio,
+        random bytes after a frame sync code by default. Returns the
+        audio.
+    """
+    if audio is None:
+        audio = b'\xff\xf8' + os.urandom(20000)
+    data = b'fLaC' + block(0, stream_info()) + block(4, comment(tags))
+    for code, content in blocks:
+        data = data + block(code, content)
+    data = data + block(1, b'\x00' * padding, last=True) + audio
+    with open(path, 'wb') as f:
+        f.write(data)
+    return audio
+
+
+class LibraryTestCase(unittest.TestCase):
+    """ A test with a temporary directory and a library in it."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lib = Library(os.path.join(self.directory, 'library.db'),
+                           self.directory)
+
+    def tearDown(self):
+        self.lib._close()
+        shutil.rmtree(self.directory)
+
+    def add_item(self, name='track.flac', **fields):
+        """ Adds an item for a FLAC file called name in the directory,
+            written with the item's tags.
+        """
+        values = {'title': 'Title', 'artist': 'Artist', 'album': 'Album',
+                  'genre': 'Jazz', 'composer': '', 'year': 2000,
+                  'track': 1}
+        values.update(fields)
+        path = os.path.join(self.directory, name)
+        make_flac(path, dict((tag, str(values[tag])) for tag in
+                             ('title', 'artist', 'album', 'genre')))
+        item = Item(path=os.fsencode(path), **values)
+        self.lib.add(item)
+        return item
@@ -0,0 +1,81 @@
+""" Changes to an item's served tags are recorded in the header index and
+    reported as its change time.
+"""
+import os
+import sqlite3
+import unittest
+
+from beetsplug import beetFs
+from beetsplug.beetFs import ChangeTimes, HeaderIndex
+
+from helper import LibraryTestCase
+
+
+class ChangeTimesTest(LibraryTestCase):
+    def setUp(self):
+        super(ChangeTimesTest, self).setUp()
+        self.item = self.add_item()
+        self.path = os.path.join(self.directory, 'index.db')
+        self.index = HeaderIndex(self.path)
+        self.times = ChangeTimes(self.lib, self.index)
+
+    def tags(self, **changes):
+        return dict(beetFs.item_tags(self.item), **changes)
+
+    def test_recorded(self):
+        self.index.lookup(self.item)
+        self.assertIsNone(self.times.get(self.item.id))
+        self.index.touch_many([(self.item.id, 5 * 10 ** 9,
+                                self.tags(title='New'))])
+        self.assertEqual(self.times.get(self.item.id), 5)
+
+    def test_unchanged_tags_skipped(self):
+        self.index.lookup(self.item)
+        # as the file has them
+        self.index.touch_many([(self.item.id, 10 ** 9, self.tags())])
+        self.assertIsNone(self.times.get(self.item.id))
+        # as they were at the last recorded change
+        self.index.touch_many([(self.item.id, 2 * 10 ** 9,
+                                self.tags(title='New'))])
+        self.index.touch_many([(self.item.id, 3 * 10 ** 9,
+                                self.tags(title='New'))])
+        self.assertEqual(self.times.get(self.item.id), 2)
+
+    def test_never_scanned_skipped(self):
+        self.index.touch_many([(self.item.id, 10 ** 9,
+                                self.tags(title='New'))])
+        self.assertIsNone(self.times.get(self.item.id))
+
+    def test_recorded_on_exit(self):
+        self.index.lookup(self.item)
+        self.item.title = 'New'
+        beetFs.library_changed(self.lib, self.item)
+        self.assertIn(self.item.id, beetFs.pending_changes)
+        beetFs.record_changes(self.lib, self.index)
+        self.assertEqual(beetFs.pending_changes, {})
+        self.assertIsNotNone(self.times.get(self.item.id))
+
+    def test_changes_without_tags_migrated(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("DROP TABLE modified")
+        connection.execute(
+            "CREATE TABLE modified (id INTEGER PRIMARY KEY, time INTEGER)")
+        connection.execute("INSERT INTO modified VALUES (?, ?)",
+                           (self.item.id, 10 ** 9))
+        connection.commit()
+        connection.close()
+
+        index = HeaderIndex(self.path)
+        index.lookup(self.item)
+        times = ChangeTimes(self.lib, index)
+        self.assertEqual(times.get(self.item.id), 1)
+        # compared with the file's tags, which it has
+        index.touch_many([(self.item.id, 2 * 10 ** 9, self.tags())])
+        self.assertEqual(times.get(self.item.id), 1)
+        index.touch_many([(self.item.id, 3 * 10 ** 9,
+                           self.tags(title='New'))])
+        self.assertEqual(times.get(self.item.id), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
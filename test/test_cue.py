@@ -0,0 +1,133 @@
+""" Tracks of a FLAC+CUE image: each is cut at the seek point at or
+    before its INDEX 01 and served as a header of its own followed by the
+    image's frames from there.
+"""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mutagen.flac import (FLAC, CueSheet, CueSheetTrack, CueSheetTrackIndex,
+                          SeekPoint, SeekTable)
+
+from beetsplug.beetFs import CueImage, HeaderLayout
+
+from helper import block, comment, stream_info
+
+BUDGET = 4096
+TAGS = {'title': 'Image', 'album': 'Album', 'artist': 'Artist',
+        'genre': 'Jazz'}
+# ten frames of 4096 samples, each 100 bytes long
+FRAME_SAMPLES = 4096
+FRAME_BYTES = 100
+SAMPLES = 10 * FRAME_SAMPLES
+
+
+def frames():
+    return b''.join(b'\xff\xf8' + bytes([number]) * (FRAME_BYTES - 2)
+                    for number in range(10))
+
+
+def cue_sheet(starts):
+    """ A cue sheet with a track starting at each of starts, given as
+        (start, INDEX 01 offset) in samples, and the lead-out.
+    """
+    sheet = CueSheet(None)
+    sheet.media_catalog_number = b''
+    sheet.lead_in_samples = 88200
+    sheet.compact_disc = True
+    for number, (start, index) in enumerate(starts, 1):
+        track = CueSheetTrack(number, start)
+        track.indexes = [CueSheetTrackIndex(1, index)]
+        sheet.tracks.append(track)
+    sheet.tracks.append(CueSheetTrack(170, SAMPLES))
+    return sheet.write()
+
+
+def seek_table(points):
+    table = SeekTable(None)
+    table.seekpoints = [SeekPoint(point * FRAME_SAMPLES,
+                                  point * FRAME_BYTES, FRAME_SAMPLES)
+                        for point in points]
+    return table.write()
+
+
+class CueImageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'image.flac').encode()
+        # a seek point every other frame; track 2 starts between two, and
+        # track 3's INDEX 01 comes after its start
+        self.write([(0, 0), (10000, 0), (20000, 588)], [0, 2, 4, 6, 8])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, starts, points):
+        header = b'fLaC' + block(0, stream_info(SAMPLES))
+        if points:
+            header = header + block(3, seek_table(points))
+        header = (header + block(5, cue_sheet(starts))
+                  + block(4, comment(TAGS))
+                  + block(1, b'\x00' * 100, last=True))
+        self.audio_offset = len(header)
+        self.data = header + frames()
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def image(self):
+        return CueImage.read(self.path, HeaderLayout.scan(self.path))
+
+    def served(self, image, number):
+        """ The bytes of track number as they are served."""
+        samples, start, end = image.tracks[number]
+        header = image.header(number, dict(TAGS, title='Track %02i'
+                                           % number), BUDGET)
+        return header, header + self.data[start:end]
+
+    def test_tracks_start_at_seek_points(self):
+        start = self.audio_offset
+        self.assertEqual(dict(self.image().tracks), {
+            # 10000 falls between the seek points at 8192 and 16384
+            1: (2 * FRAME_SAMPLES, start, start + 2 * FRAME_BYTES),
+            # INDEX 01 of track 3 is at 20588
+            2: (2 * FRAME_SAMPLES, start + 2 * FRAME_BYTES,
+                start + 4 * FRAME_BYTES),
+            3: (6 * FRAME_SAMPLES, start + 4 * FRAME_BYTES,
+                start + 10 * FRAME_BYTES),
+        })
+
+    def test_served_track(self):
+        image = self.image()
+        header, data = self.served(image, 2)
+        self.assertEqual(image.size(2, dict(TAGS, title='Track 02'),
+                                    BUDGET), len(data))
+
+        flac = FLAC(io.BytesIO(data))
+        self.assertEqual(flac.info.total_samples, 2 * FRAME_SAMPLES)
+        self.assertEqual(flac.info.sample_rate, 44100)
+        self.assertEqual(flac.info.md5_signature, 0)
+        self.assertEqual(flac['title'], ['Track 02'])
+        self.assertEqual(flac['album'], ['Album'])
+        self.assertIsNone(flac.cuesheet)
+        self.assertIsNone(flac.seektable)
+
+        # the audio is whole frames of the image, from the first frame at
+        # the seek point
+        self.assertEqual(data[len(header):len(header) + 3], b'\xff\xf8\x02')
+        self.assertEqual(len(data) - len(header), 2 * FRAME_BYTES)
+
+    def test_tracks_adjoin(self):
+        image = self.image()
+        audio = b''.join(self.served(image, number)[1][
+            len(self.served(image, number)[0]):] for number in image.tracks)
+        self.assertEqual(audio, self.data[self.audio_offset:])
+
+    def test_needs_seek_table(self):
+        self.write([(0, 0), (10000, 0), (20000, 588)], [])
+        self.assertIsNone(self.image())
+
+
+if __name__ == '__main__':
+    unittest.main()
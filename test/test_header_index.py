@@ -0,0 +1,75 @@
+""" The header index: layouts are stored per item and only trusted while
+    the file's mtime, size and path are what they were when it was
+    scanned.
+"""
+import os
+import sqlite3
+import unittest
+
+from beetsplug.beetFs import HeaderIndex, HeaderLayout
+
+from helper import LibraryTestCase, make_flac
+
+
+class HeaderIndexTest(LibraryTestCase):
+    def setUp(self):
+        super(HeaderIndexTest, self).setUp()
+        self.item = self.add_item()
+        self.index = HeaderIndex(os.path.join(self.directory, 'index.db'))
+
+    def test_lookup_scans_and_stores(self):
+        layout = self.index.lookup(self.item)
+        stored = self.index.get(self.item)
+        self.assertEqual(vars(stored), vars(layout))
+        self.assertEqual(vars(layout),
+                         vars(HeaderLayout.scan(self.item.path)))
+        st = os.stat(self.item.path)
+        self.assertEqual(self.index.stored(), {
+            self.item.id: (self.item.path, st.st_mtime_ns, st.st_size)})
+
+    def test_stale_when_file_changes(self):
+        old = self.index.lookup(self.item)
+        make_flac(self.item.path, {'title': 'Longer title'}, padding=2048)
+        self.assertIsNone(self.index.get(self.item))
+        layout = self.index.lookup(self.item)
+        self.assertNotEqual(layout.audio_offset, old.audio_offset)
+        self.assertEqual(vars(self.index.get(self.item)), vars(layout))
+
+    def test_stale_when_mtime_changes(self):
+        self.index.lookup(self.item)
+        st = os.stat(self.item.path)
+        os.utime(self.item.path, ns=(st.st_atime_ns,
+                                     st.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(self.index.get(self.item))
+
+    def test_stale_when_item_moves(self):
+        self.index.lookup(self.item)
+        moved = os.path.join(self.directory, 'moved.flac')
+        os.rename(self.item.path, moved)
+        self.item.path = os.fsencode(moved)
+        self.assertIsNone(self.index.get(self.item))
+
+    def test_entries_without_inline_blocks_are_stale(self):
+        path = os.path.join(self.directory, 'old.db')
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "CREATE TABLE headers (id INTEGER PRIMARY KEY, path BLOB, "
+            "mtime INTEGER, size INTEGER, audio_offset INTEGER, "
+            "header_length INTEGER, blocks TEXT, vorbis BLOB)")
+        layout = HeaderLayout.scan(self.item.path)
+        connection.execute(
+            "INSERT INTO headers VALUES (?, ?, ?, ?, ?, ?, '[]', ?)",
+            (self.item.id, self.item.path, layout.mtime, layout.size,
+             layout.audio_offset, layout.header_length, layout.vorbis))
+        connection.commit()
+        connection.close()
+
+        index = HeaderIndex(path)
+        self.assertIsNone(index.get(self.item))
+        self.assertEqual(index.stored(), {})
+        self.assertEqual(vars(index.lookup(self.item)), vars(layout))
+        self.assertIn(self.item.id, index.stored())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+""" Names found not to exist are remembered for a while, and forgotten
+    when the library changes.
+"""
+import unittest
+
+from beetsplug import beetFs
+from beetsplug.beetFs import NegativeCache
+
+from helper import LibraryTestCase
+
+
+class NegativeCacheTest(LibraryTestCase):
+    def test_remembered(self):
+        cache = NegativeCache(self.lib, 60, 10)
+        self.assertFalse(cache.get('/folder.jpg'))
+        cache.add('/folder.jpg')
+        self.assertTrue(cache.get('/folder.jpg'))
+        self.assertFalse(cache.get('/.DS_Store'))
+        self.assertEqual(cache.usage(), {'negative_entries': 1,
+                                         'negative_hits': 1,
+                                         'negative_misses': 1})
+
+    def test_expires(self):
+        cache = NegativeCache(self.lib, 0, 10)
+        cache.get('/folder.jpg')
+        cache.add('/folder.jpg')
+        self.assertFalse(cache.get('/folder.jpg'))
+        self.assertEqual(cache.usage()['negative_entries'], 0)
+
+    def test_flushed_when_library_changes(self):
+        cache = NegativeCache(self.lib, 60, 10)
+        cache.get('/folder.jpg')
+        cache.add('/folder.jpg')
+        beetFs.library_changed(self.lib, self.add_item())
+        self.assertFalse(cache.get('/folder.jpg'))
+        self.assertEqual(cache.usage()['negative_entries'], 0)
+
+    def test_oldest_go_first(self):
+        cache = NegativeCache(self.lib, 60, 2)
+        for path in ('/a', '/b', '/a', '/c'):
+            cache.get(path)
+            cache.add(path)
+        self.assertEqual([path for path in ('/a', '/b', '/c')
+                          if cache.get(path)], ['/a', '/c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+""" Served headers are padded so that tag edits rarely change their size
+    or the offset of the audio.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from beetsplug.beetFs import HeaderLayout, padded_size
+
+from helper import make_flac
+
+BUDGET = 4096
+TAGS = {'title': 'Title', 'artist': 'Artist', 'album': 'Album',
+        'genre': 'Jazz'}
+
+
+class PaddedSizeTest(unittest.TestCase):
+    def test_stable_within_budget(self):
+        base = 1000
+        sizes = set(padded_size(content, base, BUDGET)
+                    for content in range(200, base + BUDGET - 4 + 1))
+        self.assertEqual(sizes, {base + BUDGET})
+
+    def test_grows_in_whole_budgets(self):
+        base = 1000
+        self.assertEqual(padded_size(base + BUDGET - 3, base, BUDGET),
+                         base + 2 * BUDGET)
+        self.assertEqual(padded_size(base + 5 * BUDGET, base, BUDGET),
+                         base + 6 * BUDGET)
+
+    def test_room_for_padding_block(self):
+        for content in range(0, 3 * BUDGET, 97):
+            self.assertGreaterEqual(padded_size(content, 100, BUDGET),
+                                    content + 4)
+
+
+class HeaderSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'track.flac').encode()
+        # the file's own padding doesn't count
+        make_flac(self.path, TAGS, padding=10000)
+        self.layout = HeaderLayout.scan(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ignores_file_padding(self):
+        make_flac(self.path, TAGS, padding=0)
+        self.assertEqual(HeaderLayout.scan(self.path).header_size(
+            TAGS, BUDGET), self.layout.header_size(TAGS, BUDGET))
+
+    def test_stable_across_edits(self):
+        size = self.layout.header_size(TAGS, BUDGET)
+        for title in ('', 'T', 'A much longer title than before' * 10):
+            self.assertEqual(self.layout.header_size(
+                dict(TAGS, title=title), BUDGET), size)
+
+    def test_outgrowing_budget(self):
+        size = self.layout.header_size(TAGS, BUDGET)
+        self.assertEqual(self.layout.header_size(
+            dict(TAGS, title='x' * (BUDGET + 100)), BUDGET),
+            size + BUDGET)
+
+    def test_served_header_has_that_size(self):
+        for title in ('Title', 'x' * 3000, 'x' * 5000):
+            tags = dict(TAGS, title=title)
+            with open(self.path, 'rb') as f:
+                header = self.layout.build(
+                    tags, f.fileno(), self.layout.padding(tags, BUDGET))
+            self.assertEqual(len(header),
+                             self.layout.header_size(tags, BUDGET))
+
+
+if __name__ == '__main__':
+    unittest.main()
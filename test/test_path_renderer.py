@@ -0,0 +1,52 @@
+""" PathRenderer and the tree built from it: paths come out as beets
+    would template them, and items that render to the same name are told
+    apart the same way on every mount.
+"""
+import unittest
+
+from beetsplug.beetFs import PATH_FORMAT, PathRenderer, build_structure
+
+from helper import LibraryTestCase
+
+
+class PathRendererTest(LibraryTestCase):
+    def test_render(self):
+        item = self.add_item('a.flac', artist='AC/DC', album='Back',
+                             year=1980, track=3, title='Title')
+        self.assertEqual(PathRenderer(PATH_FORMAT).render(item),
+                         ['AC_DC', 'Back (1980) [FLAC]',
+                          '03 - AC_DC - Title.flac'])
+
+    def test_render_with_values(self):
+        item = self.add_item('a.flac', track=1, title='Whole')
+        self.assertEqual(PathRenderer('$track $title').render(
+            item, {'track': 2, 'title': 'Part'}), ['02 Part'])
+
+    def test_escapes(self):
+        item = self.add_item('a.flac', title='Title')
+        self.assertEqual(PathRenderer('$$ {$title}').render(item),
+                         ['$ {Title}'])
+
+    def test_rows_match_items(self):
+        for name in ('a.flac', 'b.flac', 'c.flac'):
+            self.add_item(name, title=name)
+        renderer = PathRenderer(PATH_FORMAT)
+        self.assertEqual(list(renderer.render_rows(self.lib, batch=2)),
+                         [(item.id, renderer.render(item))
+                          for item in self.lib.items()])
+
+    def test_colliding_names(self):
+        first = self.add_item('a.flac', title='Same')
+        second = self.add_item('b.flac', title='Same')
+        third = self.add_item('c.flac', title='Same')
+        root = build_structure(self.lib, PathRenderer(PATH_FORMAT))
+        node = root.getnode(['Artist', 'Album (2000) [FLAC]'])
+        self.assertEqual(node.files, {
+            '01 - Artist - Same.flac': first.id,
+            '01 - Artist - Same (2).flac': second.id,
+            '01 - Artist - Same (3).flac': third.id,
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+""" /.query/ listings: run on first use, kept for their TTL and dropped
+    when the library changes.
+"""
+import unittest
+
+from beetsplug import beetFs
+from beetsplug.beetFs import QueryCache
+
+from helper import LibraryTestCase
+
+
+class QueryCacheTest(LibraryTestCase):
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        self.first = self.add_item('a.flac', title='First', album='Jazz')
+        self.add_item('b.flac', title='Second', album='Rock')
+
+    def ids(self, node):
+        return sorted(node.files.values())
+
+    def test_runs_query(self):
+        cache = QueryCache(self.lib, 60, 10)
+        self.assertEqual(cache.queries(), [])
+        self.assertEqual(self.ids(cache.get('album:Jazz')), [self.first.id])
+        self.assertEqual(cache.queries(), ['album:Jazz'])
+
+    def test_kept_for_ttl(self):
+        cache = QueryCache(self.lib, 60, 10)
+        node = cache.get('album:Jazz')
+        self.assertIs(cache.get('album:Jazz'), node)
+
+    def test_expires(self):
+        cache = QueryCache(self.lib, 0, 10)
+        node = cache.get('album:Jazz')
+        self.assertIsNot(cache.get('album:Jazz'), node)
+
+    def test_dropped_when_library_changes(self):
+        cache = QueryCache(self.lib, 60, 10)
+        cache.get('album:Jazz')
+        item = self.add_item('c.flac', title='Third', album='Jazz')
+        beetFs.library_changed(self.lib, item)
+        self.assertEqual(cache.queries(), [])
+        self.assertEqual(self.ids(cache.get('album:Jazz')),
+                         [self.first.id, item.id])
+
+    def test_least_recently_used_go_first(self):
+        cache = QueryCache(self.lib, 60, 2)
+        cache.get('album:Jazz')
+        cache.get('album:Rock')
+        cache.get('album:Jazz')
+        cache.get('title:Second')
+        self.assertEqual(cache.queries(), ['album:Jazz', 'title:Second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+""" readdir: listings come in a stable order, and every entry carries
+    the offset to resume after it.
+"""
+import stat
+import unittest
+from unittest import mock
+
+from beetsplug import beetFs
+from beetsplug.beetFs import FSNode, beetFileSystem
+
+
+class ReaddirTest(unittest.TestCase):
+    def setUp(self):
+        self.root = FSNode({}, {})
+        self.root.adddir([], 'Artist')
+        self.root.adddir(['Artist'], 'Album')
+        self.root.adddir(['Artist'], 'Live')
+        for id, name in enumerate(['c.flac', 'a.flac', 'b.flac'], 1):
+            self.root.addfile(['Artist', 'Album'], name, id)
+        patcher = mock.patch.object(beetFs, 'directory_structure', self.root,
+                                    create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def readdir(self, path, offset=0):
+        return [(entry.name, entry.offset, entry.type) for entry
+                in beetFileSystem.readdir(None, path, offset)]
+
+    def test_sorted_directories_first(self):
+        self.assertEqual(self.readdir('/Artist/Album'), [
+            ('.', 1, stat.S_IFDIR), ('..', 2, stat.S_IFDIR),
+            ('a.flac', 3, stat.S_IFREG), ('b.flac', 4, stat.S_IFREG),
+            ('c.flac', 5, stat.S_IFREG)])
+        self.assertEqual([name for name, offset, type_
+                          in self.readdir('/Artist')][2:], ['Album', 'Live'])
+
+    def test_resume(self):
+        listing = self.readdir('/Artist/Album')
+        for name, offset, type_ in listing:
+            self.assertEqual(self.readdir('/Artist/Album', offset),
+                             listing[offset:])
+
+    def test_listing_kept_until_node_changes(self):
+        node = self.root.getnode(['Artist', 'Album'])
+        entries = node.entries()
+        self.assertIs(node.entries(), entries)
+        node.addfile([], 'd.flac', 4)
+        self.assertEqual(node.entries()[-1], ('d.flac', stat.S_IFREG))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+""" statfs adds up the filesystems holding the library and counts the
+    entries of the tree, and keeps the result for its TTL.
+"""
+import os
+import unittest
+from unittest import mock
+
+from beetsplug import beetFs
+from beetsplug.beetFs import FSNode, LibrarySpace
+
+from helper import LibraryTestCase
+
+stat = os.stat
+
+
+def fake_stat(path, *args, **kwargs):
+    """ os.stat, with directories called 'other' on a device of their
+        own.
+    """
+    st = stat(path, *args, **kwargs)
+    if os.path.basename(path) == b'other':
+        return mock.Mock(st_dev=st.st_dev + 1)
+    return st
+
+
+def fake_statvfs(path):
+    """ A 1 GiB filesystem in 1 KiB blocks, a quarter of it used."""
+    return mock.Mock(f_frsize=1024, f_blocks=2 ** 20, f_bfree=3 * 2 ** 18,
+                     f_bavail=2 ** 19)
+
+
+class LibrarySpaceTest(LibraryTestCase):
+    def setUp(self):
+        super(LibrarySpaceTest, self).setUp()
+        self.add_item('a.flac')
+        self.root = FSNode({}, {})
+        album = self.root.makedirs(['Artist', 'Album'])
+        album.addfile([], 'a.flac', 1)
+        album.addfile([], 'b.flac', 2)
+        album.cover = mock.Mock(format=None)
+        self.root.makedirs(['Artist', 'Live']).cover = mock.Mock(
+            format='jpg')
+        for name, function in (('stat', fake_stat),
+                               ('statvfs', fake_statvfs)):
+            patcher = mock.patch.object(beetFs.os, name,
+                                        side_effect=function)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def add_elsewhere(self):
+        os.mkdir(os.path.join(self.directory, 'other'))
+        item = self.add_item(os.path.join('other', 'b.flac'))
+        beetFs.library_changed(self.lib, item)
+
+    def test_totals(self):
+        st = LibrarySpace(self.lib, self.root, 5).statfs()
+        self.assertEqual((st.f_blocks, st.f_bfree, st.f_bavail),
+                         (2 ** 18, 3 * 2 ** 16, 2 ** 17))
+        # three directories, two tracks and the cover that has a name
+        self.assertEqual((st.f_files, st.f_ffree), (6, 6))
+
+    def test_added_up_across_devices(self):
+        self.add_elsewhere()
+        space = LibrarySpace(self.lib, self.root, 5)
+        st = space.statfs()
+        self.assertEqual(space.usage(), {'statfs_devices': 2})
+        self.assertEqual(st.f_blocks, 2 * 2 ** 18)
+
+    def test_kept_for_ttl(self):
+        space = LibrarySpace(self.lib, self.root, 60)
+        st = space.statfs()
+        self.assertIs(space.statfs(), st)
+        self.assertEqual(self.statvfs.call_count, 1)
+
+    def test_devices_found_again_when_library_changes(self):
+        space = LibrarySpace(self.lib, self.root, 0)
+        self.assertEqual(space.statfs().f_blocks, 2 ** 18)
+        self.add_elsewhere()
+        self.assertEqual(space.statfs().f_blocks, 2 * 2 ** 18)
+        self.assertEqual(space.usage(), {'statfs_devices': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
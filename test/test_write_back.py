@@ -0,0 +1,82 @@
+""" Round trips through write_header(): tags written in place and by
+    rewriting the file read back with mutagen, and the audio is untouched.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from mutagen.flac import FLAC
+
+from beetsplug.beetFs import HeaderLayout, write_header
+
+from helper import make_flac
+
+BUDGET = 4096
+TAGS = {'title': 'Title', 'album': 'Album', 'artist': 'Artist',
+        'genre': 'Jazz'}
+
+
+class WriteHeaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'track.flac').encode()
+        self.audio = make_flac(self.path, TAGS)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, **changes):
+        tags = dict(TAGS, **changes)
+        id, path, outcome, layout, error = write_header(
+            (1, self.path, tags, BUDGET))
+        self.assertIsNone(error)
+        self.assertEqual(path, self.path)
+        return tags, outcome, layout
+
+    def assertRoundTrip(self, tags, layout):
+        flac = FLAC(self.path)
+        for tag, value in tags.items():
+            self.assertEqual(flac[tag], [value])
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[layout.audio_offset:], self.audio)
+        self.assertEqual(layout.size, len(data))
+        self.assertFalse(HeaderLayout.scan(self.path).differs(tags))
+
+    def test_unchanged(self):
+        tags, outcome, layout = self.write()
+        self.assertEqual(outcome, 'unchanged')
+        self.assertRoundTrip(tags, layout)
+
+    def test_in_place(self):
+        size = os.path.getsize(self.path)
+        tags, outcome, layout = self.write(title='Another title')
+        self.assertEqual(outcome, 'in place')
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertRoundTrip(tags, layout)
+
+    def test_rewritten(self):
+        tags, outcome, layout = self.write(title='x' * 2000)
+        self.assertEqual(outcome, 'rewritten')
+        self.assertRoundTrip(tags, layout)
+        self.assertEqual(os.listdir(self.directory), ['track.flac'])
+
+        # the rewrite leaves padding, so the next change fits in place
+        tags, outcome, layout = self.write(title='y' * 2000)
+        self.assertEqual(outcome, 'in place')
+        self.assertRoundTrip(tags, layout)
+
+    def test_broken_comment(self):
+        with open(self.path, 'r+b') as f:
+            # the vendor string's length runs past the end of the block
+            f.seek(4 + 4 + 34 + 4)
+            f.write(b'\xff\xff\xff\x7f')
+        id, path, outcome, layout, error = write_header(
+            (1, self.path, TAGS, BUDGET))
+        self.assertIsNone(outcome)
+        self.assertIsNotNone(error)
+
+
+if __name__ == '__main__':
+    unittest.main()